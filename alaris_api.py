@@ -1,33 +1,172 @@
+import json
 import os
+import threading
+import time
 import requests
-from typing import Any, List, Dict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from urllib.parse import urljoin
-from dotenv import load_dotenv
 
 from requests.auth import HTTPBasicAuth
+from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError
 
+try:
+    import ijson
+except ImportError:  # pragma: no cover - streaming is optional
+    ijson = None
+
+from http_client import HTTP_CONNECT_TIMEOUT, HttpClient
 from logger import create_logger
+from settings import settings
 
+ALARIS_DOMAIN = settings.alaris_domain
+ALARIS_USER = settings.alaris_user
+ALARIS_PASSWD = settings.alaris_password
+ALARIS_TOKEN_TTL = settings.alaris_token_ttl
+TOKEN_CACHE_FILE = settings.cache_path("alaris_token.json")
 
-load_dotenv()
+logger = create_logger(__name__, 'alaris_api.log')
 
-ALARIS_DOMAIN = os.getenv("ALARIS_DOMAIN")
-ALARIS_USER = os.getenv("ALARIS_USER")
-ALARIS_PASSWD = os.getenv("PASSWORD")
+# (connect, read) timeouts per alaris endpoint, full catalogues are slow to render
+ALARIS_TIMEOUTS = {
+    "auth": (HTTP_CONNECT_TIMEOUT, 10),
+    "task": (HTTP_CONNECT_TIMEOUT, 60),
+    "product": (HTTP_CONNECT_TIMEOUT, 60),
+    "carrier": (HTTP_CONNECT_TIMEOUT, 30),
+    "account": (HTTP_CONNECT_TIMEOUT, 30),
+    "sms_rate": (HTTP_CONNECT_TIMEOUT, 120),
+}
 
-logger = create_logger(__name__, 'alaris_api.log')
+auth_client = HttpClient(timeouts=ALARIS_TIMEOUTS)
 
 
-def get_token() -> str:
-    """return auth token"""
+def request_token() -> str:
+    """request new auth token from alaris"""
     url = urljoin(ALARIS_DOMAIN, "auth")
-    auth_resp = requests.get(
+    auth_resp = auth_client.get(
         url, auth=HTTPBasicAuth(username=ALARIS_USER, password=ALARIS_PASSWD)
     )
     auth_resp.raise_for_status()
     return auth_resp.json()["token"]
 
 
+class TokenManager:
+    """
+    Keep alaris auth token in memory and in a small on-disk cache.
+
+    The token is reused until it expires (ttl seconds after it was issued) or
+    until it is invalidated, e.g. after 401 response from alaris.
+    """
+
+    def __init__(self, cache_file: str = TOKEN_CACHE_FILE, ttl: int = ALARIS_TOKEN_TTL):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def _is_valid(self) -> bool:
+        return self._token is not None and time.time() < self._expires_at
+
+    def _load(self):
+        try:
+            with open(self.cache_file) as cache_file:
+                cached = json.load(cache_file)
+            self._token = cached["token"]
+            self._expires_at = cached["expires_at"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as err:
+            logger.warning("could not read token cache %s: %s", self.cache_file, err)
+
+    def _save(self):
+        """write token to the disk cache, the token is kept in memory if it fails"""
+        tmp_path = f"{self.cache_file}.tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as cache_file:
+                json.dump({"token": self._token, "expires_at": self._expires_at}, cache_file)
+            os.replace(tmp_path, self.cache_file)
+        except OSError as err:
+            logger.warning("could not write token cache %s: %s", self.cache_file, err)
+
+    def cached_token(self) -> Optional[str]:
+        """return valid token from memory or disk cache without authentication"""
+        with self._lock:
+            if not self._is_valid():
+                self._load()
+            return self._token if self._is_valid() else None
+
+    def set_token(self, token: str):
+        """store token issued by alaris, e.g. by the async client"""
+        with self._lock:
+            self._token = token
+            self._expires_at = time.time() + self.ttl
+            self._save()
+
+    def get_token(self) -> str:
+        with self._lock:
+            if not self._is_valid():
+                self._load()
+            if not self._is_valid():
+                logger.info("request new auth token")
+                self._token = request_token()
+                self._expires_at = time.time() + self.ttl
+                self._save()
+            return self._token
+
+    def invalidate(self, token: str = None):
+        """forget current token. If token is provided forget only that token"""
+        with self._lock:
+            if token is not None and token != self._token:
+                return
+            self._token = None
+            self._expires_at = 0.0
+            try:
+                os.remove(self.cache_file)
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                logger.warning("could not remove token cache %s: %s", self.cache_file, err)
+
+
+token_manager = TokenManager()
+
+
+def get_token() -> str:
+    """return auth token"""
+    return token_manager.get_token()
+
+
+class AlarisSession(HttpClient):
+    """
+    Pooled and retrying session which authorizes requests with token from TokenManager.
+
+    On 401 response the token is invalidated and the request is repeated once
+    with a new token.
+    """
+
+    def __init__(self, manager: TokenManager = None):
+        super().__init__(timeouts=ALARIS_TIMEOUTS)
+        self.token_manager = manager or token_manager
+
+    def _authorized_request(self, method, url, token, **kwargs):
+        # header is set per request, so the session can be shared between threads
+        headers = dict(kwargs.pop("headers", None) or {})
+        headers["Authorization"] = f"Bearer {token}"
+        return super().request(method, url, headers=headers, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        token = self.token_manager.get_token()
+        resp = self._authorized_request(method, url, token, **kwargs)
+        if resp.status_code == 401:
+            logger.info("auth token was rejected, re-authenticate")
+            resp.close()
+            self.token_manager.invalidate(token)
+            token = self.token_manager.get_token()
+            resp = self._authorized_request(method, url, token, **kwargs)
+        return resp
+
+
 def get_tasks(session: requests.Session, task_type_id: int, **kwargs) -> Any:
     """return list of task with provided task_type_id"""
     url = urljoin(ALARIS_DOMAIN, "task")
@@ -39,6 +178,38 @@ def get_tasks(session: requests.Session, task_type_id: int, **kwargs) -> Any:
     return task_resp.json()
 
 
+def iter_tasks(session: requests.Session, task_type_id: int, **kwargs) -> Iterator[Dict]:
+    """
+    yield tasks with provided task_type_id one by one.
+
+    The response is parsed incrementally with ijson when it is installed,
+    otherwise it is loaded as a whole and iterated. Errors of the stream are
+    raised as requests exceptions, like task_resp.json() does.
+    """
+    url = urljoin(ALARIS_DOMAIN, "task")
+    payload = {"task_type_id": task_type_id}
+    payload.update(kwargs)
+    task_resp = session.get(url, params=payload, stream=ijson is not None)
+    try:
+        task_resp.raise_for_status()
+        if ijson is None:
+            yield from task_resp.json()
+            return
+        task_resp.raw.decode_content = True
+        try:
+            yield from ijson.items(task_resp.raw, "item", use_float=True)
+        except ProtocolError as err:
+            raise requests.exceptions.ChunkedEncodingError(err) from err
+        except DecodeError as err:
+            raise requests.exceptions.ContentDecodingError(err) from err
+        except ReadTimeoutError as err:
+            raise requests.exceptions.ConnectionError(err) from err
+        except ijson.JSONError as err:
+            raise requests.exceptions.InvalidJSONError(f"invalid task list: {err}") from err
+    finally:
+        task_resp.close()
+
+
 def retrieve_product(session: requests.Session, product_id: str):
     url = urljoin(ALARIS_DOMAIN, "product/")
     url = urljoin(url, product_id)
@@ -84,12 +255,56 @@ def get_carriers(session: requests.Session) -> List[Dict]:
     return car_resp.json()
 
 
+def get_reference_list(session: requests.Session, endpoint: str, etag: str = None,
+                       last_modified: str = None) -> Tuple[Optional[List[Dict]], Dict]:
+    """
+    Return (reference list, validators) for endpoint (product, carrier, account).
+
+    If etag/last_modified are provided the request is conditional and the list is
+    None when the server answers 304 Not Modified.
+    """
+    url = urljoin(ALARIS_DOMAIN, endpoint)
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    resp = session.get(url, headers=headers)
+    validators = {
+        "etag": resp.headers.get("ETag", etag),
+        "last_modified": resp.headers.get("Last-Modified", last_modified),
+    }
+    if resp.status_code == 304:
+        logger.debug("%s was not modified", endpoint)
+        return None, validators
+    resp.raise_for_status()
+    return resp.json(), validators
+
+
 def make_session(token: str) -> requests.Session:
-    session = requests.Session()
+    session = HttpClient(timeouts=ALARIS_TIMEOUTS)
     session.headers.update({"Authorization": f"Bearer {token}"})
     return session
 
 
+shared_session = None
+
+
+def get_session(manager: TokenManager = None) -> AlarisSession:
+    """
+    return session that manages auth token by itself.
+
+    Without manager the process wide session is returned, so connections are kept alive
+    between calls.
+    """
+    global shared_session
+    if manager is not None:
+        return AlarisSession(manager)
+    if shared_session is None:
+        shared_session = AlarisSession()
+    return shared_session
+
+
 def retrieve_sms_rate(session, product_id, **kwargs):
     url = urljoin(ALARIS_DOMAIN, "sms_rate")
     params = {"product_id": int(product_id)}
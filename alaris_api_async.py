@@ -0,0 +1,211 @@
+import asyncio
+import random
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urljoin
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover - async mode is optional
+    httpx = None
+
+
+import alaris_enterprise_api as eapi
+from alaris_api import (
+    ALARIS_DOMAIN,
+    ALARIS_PASSWD,
+    ALARIS_TIMEOUTS,
+    ALARIS_USER,
+    TokenManager,
+    token_manager,
+)
+from http_client import (
+    HTTP_BACKOFF_FACTOR,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_MAX_RETRIES,
+    HTTP_POOL_SIZE,
+    HTTP_READ_TIMEOUT,
+    POST_RETRY_METHODS,
+    RETRY_METHODS,
+    RETRY_STATUSES,
+    UNPROCESSED_STATUSES,
+)
+from logger import create_logger
+from settings import settings
+from metrics import metrics
+
+logger = create_logger(__name__, "alaris_api_async.log")
+
+ASYNC_CONCURRENCY = settings.alaris_async_concurrency or HTTP_POOL_SIZE
+
+
+def make_timeout(endpoint: str) -> "httpx.Timeout":
+    connect, read = ALARIS_TIMEOUTS.get(endpoint, (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return httpx.Timeout(read, connect=connect)
+
+
+class AsyncAlarisClient:
+    """
+    asyncio variant of alaris_api and alaris_enterprise_api functions.
+
+    All requests share one httpx connection pool of max_connections and at most
+    concurrency requests are in flight at once. Auth token is shared with the
+    sync functions through TokenManager, on 401 it is requested again once.
+    Requests failed with connection errors, 429 or 5xx are retried with jittered
+    exponential backoff like in HttpClient, requests which are not safe to repeat,
+    e.g. sms_rate upload, only on connect errors and UNPROCESSED_STATUSES.
+    """
+
+    def __init__(self, manager: TokenManager = None, max_connections: int = HTTP_POOL_SIZE,
+                 concurrency: int = ASYNC_CONCURRENCY):
+        if httpx is None:
+            raise RuntimeError("httpx is required for async mode, install it with pip install httpx")
+        limits = httpx.Limits(
+            max_connections=max_connections, max_keepalive_connections=max_connections
+        )
+        self.client = httpx.AsyncClient(limits=limits)
+        self.token_manager = manager or token_manager
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self._auth_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def _send(self, method: str, url: str, timeout, methods=RETRY_METHODS,
+                    **kwargs) -> "httpx.Response":
+        repeatable = method in methods
+        retry_statuses = RETRY_STATUSES if repeatable else UNPROCESSED_STATUSES
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            try:
+                async with self.semaphore:
+                    resp = await self.client.request(method, url, timeout=timeout, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+                if attempt == HTTP_MAX_RETRIES:
+                    raise
+            except httpx.TransportError:
+                if not repeatable or attempt == HTTP_MAX_RETRIES:
+                    raise
+            else:
+                metrics.incr("http_requests")
+                metrics.incr("http_bytes_downloaded", len(resp.content))
+                if resp.status_code not in retry_statuses or attempt == HTTP_MAX_RETRIES:
+                    return resp
+            metrics.incr("http_retries")
+            backoff = HTTP_BACKOFF_FACTOR * (2 ** attempt)
+            await asyncio.sleep(random.uniform(0, backoff))
+
+    async def get_token(self, force: bool = False) -> str:
+        token = None if force else self.token_manager.cached_token()
+        if token is not None:
+            return token
+        async with self._auth_lock:
+            token = None if force else self.token_manager.cached_token()
+            if token is not None:
+                return token
+            logger.info("request new auth token")
+            resp = await self._send(
+                "GET",
+                urljoin(ALARIS_DOMAIN, "auth"),
+                make_timeout("auth"),
+                auth=(ALARIS_USER, ALARIS_PASSWD),
+            )
+            resp.raise_for_status()
+            token = resp.json()["token"]
+            self.token_manager.set_token(token)
+            return token
+
+    async def request(self, method: str, endpoint: str, path: str = "", **kwargs) -> "httpx.Response":
+        url = urljoin(ALARIS_DOMAIN, endpoint)
+        if path:
+            url = urljoin(f"{url}/", path)
+        headers = dict(kwargs.pop("headers", None) or {})
+        token = await self.get_token()
+        headers["Authorization"] = f"Bearer {token}"
+        resp = await self._send(method, url, make_timeout(endpoint), headers=headers, **kwargs)
+        if resp.status_code == 401:
+            logger.info("auth token was rejected, re-authenticate")
+            self.token_manager.invalidate(token)
+            headers["Authorization"] = f"Bearer {await self.get_token(force=True)}"
+            resp = await self._send(method, url, make_timeout(endpoint), headers=headers, **kwargs)
+        return resp
+
+    async def _get_json(self, endpoint: str, path: str = "", **kwargs):
+        resp = await self.request("GET", endpoint, path, **kwargs)
+        resp.raise_for_status()
+        return resp.json()
+
+    async def get_tasks(self, task_type_id: int, **kwargs):
+        params = {"task_type_id": task_type_id}
+        params.update(kwargs)
+        return await self._get_json("task", params=params)
+
+    async def retrieve_product(self, product_id: str):
+        return await self._get_json("product", str(product_id))
+
+    async def retrieve_carrier(self, car_id: str):
+        return await self._get_json("carrier", str(car_id))
+
+    async def retrieve_account(self, acc_id: str):
+        return await self._get_json("account", str(acc_id))
+
+    async def get_products(self) -> List[Dict]:
+        return await self._get_json("product")
+
+    async def get_accounts(self) -> List[Dict]:
+        return await self._get_json("account")
+
+    async def get_carriers(self) -> List[Dict]:
+        return await self._get_json("carrier")
+
+    async def get_reference_list(self, endpoint: str, etag: str = None,
+                                 last_modified: str = None) -> Tuple[Optional[List[Dict]], Dict]:
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        resp = await self.request("GET", endpoint, headers=headers)
+        validators = {
+            "etag": resp.headers.get("ETag", etag),
+            "last_modified": resp.headers.get("Last-Modified", last_modified),
+        }
+        if resp.status_code == 304:
+            return None, validators
+        resp.raise_for_status()
+        return resp.json(), validators
+
+    async def retrieve_sms_rate(self, product_id, **kwargs):
+        params = {"product_id": int(product_id)}
+        params.update(kwargs)
+        return await self._get_json("sms_rate", params=params)
+
+    async def update_sms_rate(self, product_id, new_rates):
+        payload = {"product_id": product_id, "rows": new_rates}
+        resp = await self.request("POST", "sms_rate", json=payload)
+        resp.raise_for_status()
+        return resp.json()
+
+    async def get_raw_sms_rates(self, product: str, start_date: str, end_date: str,
+                                mccmnc_list: str = "") -> List:
+        """async variant of alaris_enterprise_api.get_raw_sms_rates"""
+        payload = eapi.eapi_client.make_call(
+            "get_raw_sms_rate_list",
+            eapi.raw_sms_rates_args(product, start_date, end_date, mccmnc_list),
+        )
+        logger.info(payload)
+        resp = await self._send(
+            "POST",
+            eapi.EAPI_URL,
+            httpx.Timeout(eapi.EAPI_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            methods=POST_RETRY_METHODS,
+            json=payload,
+        )
+        resp.raise_for_status()
+        answer = resp.json()
+        eapi.check_eapi_answer(answer)
+        return answer["result"]["data"]
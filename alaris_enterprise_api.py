@@ -1,17 +1,28 @@
-import os
-from typing import List
+import itertools
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+from typing import Dict, Iterable, Iterator, List, Tuple
 
-import requests
-
-from dotenv import load_dotenv
 
+from http_client import HTTP_CONNECT_TIMEOUT, POST_RETRY_METHODS, HttpClient, make_retry
 from logger import create_logger
+from settings import settings
+from metrics import metrics
 
-load_dotenv()
 logger = create_logger(__name__, "alaris_enterprise_api.log")
 
-EAPI_URL = os.getenv("ALARIS_EAPI_DOMAIN")
-EAPI_USER = os.getenv("ALARIS_EAPI_USER")
+EAPI_URL = settings.eapi_url
+EAPI_USER = settings.eapi_user
+EAPI_READ_TIMEOUT = settings.eapi_read_timeout
+
+EAPI_WINDOW_DAYS = settings.eapi_window_days
+EAPI_MCCMNC_CHUNK_SIZE = settings.eapi_mccmnc_chunk_size
+EAPI_WORKERS = settings.eapi_workers
+
+EAPI_BATCH_SIZE = settings.eapi_batch_size
+EAPI_AUTH = settings.eapi_auth
 
 
 class EAPIError(Exception):
@@ -19,8 +30,100 @@ class EAPIError(Exception):
     EAPI main exception
     """
 
-    def __init__(self, message):
+    def __init__(self, message, code=None, call_id=None):
         super().__init__(message)
+        self.code = code
+        self.call_id = call_id
+
+
+class EAPIClient:
+    """
+    JSON-RPC 2.0 client for Alaris Enterprise API.
+
+    call() sends a single Enterprise.Auto call, batch() sends many calls in one
+    POST and returns their results in the order of calls.
+    """
+
+    def __init__(self, url: str = EAPI_URL, auth: str = EAPI_AUTH, session: HttpClient = None):
+        self.url = url
+        self.auth = auth
+        # JSON-RPC calls only read rates, so their POSTs are retried on any error
+        self.session = session or HttpClient(retry=make_retry(methods=POST_RETRY_METHODS))
+        self._ids = itertools.count(1)
+        self._ids_lock = threading.Lock()
+
+    def make_call(self, name: str, args: Dict) -> Dict:
+        if not self.auth:
+            raise EAPIError("ALARIS_EAPI_AUTH is not set, it is required for Enterprise API calls")
+        with self._ids_lock:
+            call_id = next(self._ids)
+        return {
+            "id": call_id,
+            "jsonrpc": "2.0",
+            "method": "Enterprise.Auto",
+            "params": {
+                "name": name,
+                "args": args,
+                "auth": self.auth,
+            },
+        }
+
+    def _post(self, payload):
+        resp = self.session.post(
+            self.url, json=payload, timeout=(HTTP_CONNECT_TIMEOUT, EAPI_READ_TIMEOUT)
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    def call(self, name: str, **args):
+        payload = self.make_call(name, args)
+        logger.info(payload)
+        with metrics.span(f"eapi.{name}"):
+            answer = self._post(payload)
+        check_eapi_answer(answer)
+        return answer["result"]
+
+    def batch(self, calls: List[Tuple[str, Dict]]) -> List:
+        """
+        Send (name, args) calls in one JSON-RPC batch request.
+
+        Returns list with result of every call, a call which failed is represented
+        by EAPIError instance, so one failed call does not hide the others.
+        """
+        payload = [self.make_call(name, args) for name, args in calls]
+        logger.info(payload)
+        with metrics.span("eapi.batch"):
+            answer = self._post(payload)
+        if not isinstance(answer, list):
+            # the whole batch was rejected, e.g. with parse or invalid request error
+            check_eapi_answer(answer)
+            raise EAPIError(f"unexpected answer for batch request: {answer}")
+        answers = {item.get("id"): item for item in answer}
+        results = []
+        for call in payload:
+            item = answers.get(call["id"])
+            if item is None:
+                results.append(EAPIError("no answer for call", call_id=call["id"]))
+            elif item.get("error"):
+                error = item["error"]
+                results.append(
+                    EAPIError(error.get("message"), code=error.get("code"), call_id=call["id"])
+                )
+            else:
+                results.append(item["result"])
+        return results
+
+
+eapi_client = EAPIClient()
+
+
+def raw_sms_rates_args(product: str, start_date: str, end_date: str, mccmnc_list: str = "") -> Dict:
+    return {
+        "product_list": product,
+        "start_date": start_date,
+        "end_date": end_date,
+        "mccmnc_list": mccmnc_list,
+    }
 
 
 def get_raw_sms_rates(product: str, start_date: str, end_date: str, **kwargs) -> List:
@@ -34,26 +137,30 @@ def get_raw_sms_rates(product: str, start_date: str, end_date: str, **kwargs) ->
 
     :return:
     """
-    payload = {
-        "id": 1,
-        "jsonrpc": "2.0",
-        "method": "Enterprise.Auto",
-        "params": {
-            "name": "get_raw_sms_rate_list",
-            "args": {
-                "product_list": product,
-                "start_date": start_date,
-                "end_date": end_date,
-                "mccmnc_list": kwargs.get("mccmnc_list", ""),
-            },
-            "auth": "YS5wb2x1bWVzdG55aTpWcXAqR3cycw==",
-        },
-    }
-    rate_resp = requests.post(EAPI_URL, json=payload)
-    logger.info(payload)
-    rate_resp.raise_for_status()
-    check_eapi_answer(rate_resp.json())
-    return rate_resp.json()["result"]["data"]
+    result = eapi_client.call(
+        "get_raw_sms_rate_list",
+        **raw_sms_rates_args(product, start_date, end_date, kwargs.get("mccmnc_list", "")),
+    )
+    return result["data"]
+
+
+def get_raw_sms_rates_batch(queries: List[Dict]) -> List[List]:
+    """
+    Getting lists of rates for several queries in one request.
+
+    :param queries: list of dicts with product, start_date, end_date and optional mccmnc_list
+    :return: list of rate lists in the order of queries
+    :raise EAPIError: if any of the calls failed
+    """
+    if len(queries) == 1:
+        return [get_raw_sms_rates(**queries[0])]
+    results = eapi_client.batch(
+        [("get_raw_sms_rate_list", raw_sms_rates_args(**query)) for query in queries]
+    )
+    for result in results:
+        if isinstance(result, EAPIError):
+            raise result
+    return [result["data"] for result in results]
 
 
 def check_eapi_answer(answer: dict):
@@ -64,4 +171,88 @@ def check_eapi_answer(answer: dict):
     """
     error = answer.get("error")
     if error:
-        raise EAPIError(error["message"])
+        raise EAPIError(error["message"], code=error.get("code"), call_id=answer.get("id"))
+
+
+def split_date_range(start_date: str, end_date: str, days: int) -> List[Tuple[str, str]]:
+    """split inclusive YYYY-MM-DD range into not overlapping windows of at most days days"""
+    start = date.fromisoformat(start_date)
+    end = date.fromisoformat(end_date)
+    if days <= 0:
+        return [(start_date, end_date)]
+    windows = []
+    while start <= end:
+        window_end = min(start + timedelta(days=days - 1), end)
+        windows.append((start.isoformat(), window_end.isoformat()))
+        start = window_end + timedelta(days=1)
+    return windows
+
+
+def split_mccmnc_list(mccmnc_list: str, chunk_size: int) -> List[str]:
+    codes = [code for code in mccmnc_list.split(",") if code]
+    if not codes or chunk_size <= 0:
+        return [mccmnc_list]
+    return [",".join(codes[i:i + chunk_size]) for i in range(0, len(codes), chunk_size)]
+
+
+def rate_windows(start_date: str, end_date: str, mccmnc_list: str = "",
+                 window_days: int = EAPI_WINDOW_DAYS,
+                 mccmnc_chunk_size: int = EAPI_MCCMNC_CHUNK_SIZE) -> List[Tuple[str, str, str]]:
+    """return (start_date, end_date, mccmnc_list) windows of a raw rates query"""
+    return [
+        (window_start, window_end, codes)
+        for window_start, window_end in split_date_range(start_date, end_date, window_days)
+        for codes in split_mccmnc_list(mccmnc_list, mccmnc_chunk_size)
+    ]
+
+
+def unique_rates(rate_lists: Iterable[List[Dict]]) -> Iterator[Dict]:
+    """yield rates of all lists, a rate returned for several windows is yielded once"""
+    seen = set()
+    for rates in rate_lists:
+        for rate in rates:
+            rate_id = json.dumps(rate, sort_keys=True)
+            if rate_id in seen:
+                continue
+            seen.add(rate_id)
+            yield rate
+
+
+def iter_raw_sms_rates(product: str, start_date: str, end_date: str, mccmnc_list: str = "",
+                       window_days: int = EAPI_WINDOW_DAYS,
+                       mccmnc_chunk_size: int = EAPI_MCCMNC_CHUNK_SIZE,
+                       workers: int = EAPI_WORKERS,
+                       batch_size: int = EAPI_BATCH_SIZE) -> Iterator[Dict]:
+    """
+    Yield raw rates like get_raw_sms_rates, but query them by windows.
+
+    The period is split into windows of window_days days and mccmnc_list into chunks
+    of mccmnc_chunk_size codes. Windows are sent as JSON-RPC batches of batch_size
+    calls, batches are requested concurrently and rows are yielded as soon as a
+    batch is received. A rate which overlaps several date windows is yielded once.
+    """
+    windows = rate_windows(start_date, end_date, mccmnc_list, window_days, mccmnc_chunk_size)
+    logger.info("retrieve rates of %s in %s windows", product, len(windows))
+    batches = [windows[i:i + batch_size] for i in range(0, len(windows), batch_size)]
+
+    def received_rate_lists(executor):
+        futures = [
+            executor.submit(
+                get_raw_sms_rates_batch,
+                [
+                    {
+                        "product": product,
+                        "start_date": window_start,
+                        "end_date": window_end,
+                        "mccmnc_list": codes,
+                    }
+                    for window_start, window_end, codes in batch
+                ],
+            )
+            for batch in batches
+        ]
+        for future in as_completed(futures):
+            yield from future.result()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from unique_rates(received_rate_lists(executor))
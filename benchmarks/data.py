@@ -0,0 +1,87 @@
+import json
+import random
+from datetime import date, datetime, timedelta
+from typing import Dict, List
+
+TASK_TIME_FORMAT = "%Y.%m.%d %H:%M:%S"
+
+
+def make_products(count: int) -> List[Dict]:
+    return [
+        {
+            "id": product_id,
+            "car_id": 100000 + product_id,
+            "acc_id": 200000 + product_id,
+            "descr": f"product {product_id}",
+        }
+        for product_id in range(1, count + 1)
+    ]
+
+
+def make_carriers(products: List[Dict]) -> List[Dict]:
+    return [{"id": product["car_id"], "name": f"carrier {product['car_id']}"} for product in products]
+
+
+def make_accounts(products: List[Dict]) -> List[Dict]:
+    return [{"id": product["acc_id"], "currency_code": "EUR"} for product in products]
+
+
+def make_tasks(count: int, product_count: int, recent_share: float = 0.1,
+               seed: int = 1) -> List[Dict]:
+    """
+    rerating tasks in alaris /task format.
+
+    recent_share of tasks are updated in the last minute, the rest a day ago,
+    about a tenth of the tasks are created by autorerating.
+    """
+    rnd = random.Random(seed)
+    now = datetime.utcnow()
+    tasks = []
+    for task_id in range(1, count + 1):
+        if rnd.random() < recent_share:
+            updated_at = now - timedelta(seconds=rnd.randint(1, 50))
+        else:
+            updated_at = now - timedelta(days=1, seconds=rnd.randint(0, 3600))
+        updated_time = updated_at.strftime(TASK_TIME_FORMAT)
+        params = {
+            "autorerating": "1" if rnd.random() < 0.1 else "0",
+            "src_product_ids": ",".join(
+                str(rnd.randint(1, product_count)) for _ in range(rnd.randint(1, 3))
+            ),
+            "dst_product_ids": str(rnd.randint(1, product_count)),
+            "start_date": "2024-01-01 00:00:00",
+            "end_date": "2024-01-31 23:59:59",
+            "task_start_time": "",
+        }
+        tasks.append({
+            "id": task_id,
+            "task_status": rnd.choice((0, 2, 3)),
+            "task_start_time": updated_time,
+            "task_last_update_time": updated_time,
+            "task_result": "finished",
+            "task_param_json": json.dumps(params),
+        })
+    return tasks
+
+
+def make_mccmnc_list(count: int) -> List[str]:
+    return [str(25001 + code) for code in range(count)]
+
+
+def make_rates(products: List[str], mccmnc_list: List[str], start_date: str, end_date: str,
+               zero_share: float = 0.2, seed: int = 1) -> List[Dict]:
+    """raw rates in EAPI get_raw_sms_rate_list format, zero_share of them already zero"""
+    rnd = random.Random(seed)
+    start = date.fromisoformat(start_date)
+    end = date.fromisoformat(end_date)
+    return [
+        {
+            "product_id": int(product),
+            "mccmnc": mccmnc,
+            "rate": 0 if rnd.random() < zero_share else round(rnd.uniform(0.001, 0.1), 5),
+            "rate_start_date": start.isoformat(),
+            "rate_end_date": end.isoformat(),
+        }
+        for product in products
+        for mccmnc in mccmnc_list
+    ]
@@ -0,0 +1,249 @@
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+EAPI_PATH = "eapi"
+REFERENCE_ENDPOINTS = ("product", "carrier", "account")
+
+
+class MockState:
+    """
+    Data and behaviour of the mock server.
+
+    latency seconds are added to every answer, error_rate share of alaris and
+    EAPI requests and tg_429_rate share of telegram messages get 429.
+    """
+
+    def __init__(self, tasks=None, products=None, carriers=None, accounts=None, rates=None,
+                 latency: float = 0.0, error_rate: float = 0.0, tg_429_rate: float = 0.0,
+                 retry_after: int = 1, seed: int = 1):
+        self.tasks = tasks or []
+        self.references = {
+            "product": products or [],
+            "carrier": carriers or [],
+            "account": accounts or [],
+        }
+        self.by_id = {
+            endpoint: {item["id"]: item for item in items}
+            for endpoint, items in self.references.items()
+        }
+        self.rates = rates or []
+        self.latency = latency
+        self.error_rate = error_rate
+        self.tg_429_rate = tg_429_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.counts = Counter()
+        self.updated_rates = 0
+        self.lock = threading.Lock()
+
+    def count(self, name: str, total: bool = True):
+        with self.lock:
+            self.counts[name] += 1
+            if total:
+                self.counts["total"] += 1
+
+    def fail(self, rate: float) -> bool:
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+            self.updated_rates = 0
+
+    def stats(self) -> Dict:
+        with self.lock:
+            stats = dict(self.counts)
+            stats["updated_rates"] = self.updated_rates
+        return stats
+
+    def raw_rates(self, args: Dict) -> List[Dict]:
+        products = {int(product) for product in str(args.get("product_list", "")).split(",") if product}
+        codes = {code for code in str(args.get("mccmnc_list", "")).split(",") if code}
+        start_date = args.get("start_date", "")
+        end_date = args.get("end_date", "")
+        return [
+            rate for rate in self.rates
+            if (not products or rate["product_id"] in products)
+            and (not codes or rate["mccmnc"] in codes)
+            and rate["rate_start_date"] <= end_date
+            and rate["rate_end_date"] >= start_date
+        ]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: MockState = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, obj, code: int = 200):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"null")
+
+    def route(self):
+        url = urlparse(self.path)
+        return [part for part in url.path.split("/") if part], parse_qs(url.query)
+
+    def delay(self):
+        if self.state.latency:
+            time.sleep(self.state.latency)
+
+    def do_GET(self):
+        parts, _ = self.route()
+        endpoint = parts[0] if parts else ""
+        if endpoint == "stats":
+            return self.send_json(self.state.stats())
+        self.state.count(f"GET /{endpoint}" + ("/<id>" if len(parts) > 1 else ""))
+        self.delay()
+        if self.state.fail(self.state.error_rate):
+            self.state.count("injected 429", total=False)
+            return self.send_json({"error": "too many requests"}, 429)
+        if endpoint == "auth":
+            return self.send_json({"token": "benchmark-token"})
+        if endpoint == "task":
+            return self.send_json(self.state.tasks)
+        if endpoint == "sms_rate":
+            return self.send_json([])
+        if endpoint in REFERENCE_ENDPOINTS:
+            if len(parts) == 1:
+                return self.send_json(self.state.references[endpoint])
+            item = self.state.by_id[endpoint].get(int(parts[1]))
+            if item is None:
+                return self.send_json({"error": "not found"}, 404)
+            return self.send_json(item)
+        return self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        parts, _ = self.route()
+        payload = self.read_json()
+        if parts == ["reset"]:
+            self.state.reset()
+            return self.send_json({})
+        if len(parts) == 2 and parts[0].startswith("bot") and parts[1] == "sendMessage":
+            return self.send_message()
+        endpoint = parts[0] if parts else ""
+        self.state.count(f"POST /{endpoint}")
+        self.delay()
+        if self.state.fail(self.state.error_rate):
+            self.state.count("injected 429", total=False)
+            return self.send_json({"error": "too many requests"}, 429)
+        if endpoint == "sms_rate":
+            rows = len(payload.get("rows", []))
+            with self.state.lock:
+                self.state.updated_rates += rows
+            return self.send_json({"mini_report": {"updated": rows}})
+        if endpoint == EAPI_PATH:
+            if isinstance(payload, list):
+                return self.send_json([self.eapi_answer(call) for call in payload])
+            return self.send_json(self.eapi_answer(payload))
+        return self.send_json({"error": "not found"}, 404)
+
+    def eapi_answer(self, call: Dict) -> Dict:
+        params = call.get("params", {})
+        if params.get("name") != "get_raw_sms_rate_list":
+            return {
+                "id": call.get("id"),
+                "jsonrpc": "2.0",
+                "error": {"code": -32601, "message": "unknown method"},
+            }
+        return {
+            "id": call.get("id"),
+            "jsonrpc": "2.0",
+            "result": {"data": self.state.raw_rates(params.get("args", {}))},
+        }
+
+    def send_message(self):
+        self.state.count("POST /sendMessage")
+        self.delay()
+        if self.state.fail(self.state.tg_429_rate):
+            self.state.count("injected 429", total=False)
+            return self.send_json(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests",
+                    "parameters": {"retry_after": self.state.retry_after},
+                },
+                429,
+            )
+        return self.send_json({"ok": True, "result": {}})
+
+
+class MockServer:
+    """ThreadingHTTPServer with MockHandler run in a background thread"""
+
+    def __init__(self, state: MockState, host: str = "127.0.0.1", port: int = 0):
+        handler = type("BoundMockHandler", (MockHandler,), {"state": state})
+        self.state = state
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-server", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description="mock Alaris, EAPI and telegram server")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--tasks", type=int, default=1000)
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--mccmnc", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every answer")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of 429 answers")
+    parser.add_argument("--tg-429-rate", type=float, default=0.0,
+                        help="share of telegram messages answered with 429")
+    return parser
+
+
+if __name__ == "__main__":
+    from data import make_accounts, make_carriers, make_mccmnc_list, make_products, make_rates, make_tasks
+
+    args = argument_parser().parse_args()
+    products = make_products(args.products)
+    mock_state = MockState(
+        tasks=make_tasks(args.tasks, args.products),
+        products=products,
+        carriers=make_carriers(products),
+        accounts=make_accounts(products),
+        rates=make_rates(["14023"], make_mccmnc_list(args.mccmnc), "2024-01-01", "2024-01-31"),
+        latency=args.latency,
+        error_rate=args.error_rate,
+        tg_429_rate=args.tg_429_rate,
+    )
+    server = MockServer(mock_state, port=args.port)
+    print(f"serving on {server.url}, EAPI on {server.url}/{EAPI_PATH}")
+    server.httpd.serve_forever()
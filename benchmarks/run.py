@@ -0,0 +1,141 @@
+"""
+Run main.py commands against the mock server and report wall time, request
+count and peak RSS of every scenario.
+
+    python benchmarks/run.py
+    python benchmarks/run.py --scenario rerating-large --latency 0.01 --json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from data import make_accounts, make_carriers, make_mccmnc_list, make_products, make_rates, make_tasks
+from mock_server import EAPI_PATH, MockServer, MockState
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(REPO_DIR, "main.py")
+RATE_PERIOD = ("2024-01-01", "2024-01-31")
+
+# name: (command args, tasks, products, mccmnc codes, rated products)
+SCENARIOS = {
+    "rerating-small": (["rerating-task", "--time-shift", "5"], 100, 100, 0, 0),
+    "rerating-large": (["rerating-task", "--time-shift", "5"], 20000, 20000, 0, 0),
+    "rerating-async": (["rerating-task", "--time-shift", "5", "--async"], 20000, 20000, 0, 0),
+    "rerating-notify": (["--notify", "1", "rerating-task", "--time-shift", "5"], 2000, 2000, 0, 0),
+    "rate-small": (["rate", "--products", "14023"], 0, 0, 100, 1),
+    "rate-large": (["rate", "--products", "14023"], 0, 0, 5000, 1),
+    "rate-multi-product": (["rate", "--products", "14023,14024,14025,14026"], 0, 0, 2000, 4),
+    "rate-dry-run": (["rate", "--products", "14023", "--dry-run"], 0, 0, 5000, 1),
+}
+
+
+def make_state(tasks: int, products: int, mccmnc: int, rated_products: int, **kwargs) -> MockState:
+    product_list = make_products(products)
+    rated = [str(14023 + index) for index in range(rated_products)]
+    return MockState(
+        tasks=make_tasks(tasks, max(products, 1)),
+        products=product_list,
+        carriers=make_carriers(product_list),
+        accounts=make_accounts(product_list),
+        rates=make_rates(rated, make_mccmnc_list(mccmnc), *RATE_PERIOD),
+        **kwargs,
+    )
+
+
+def command_env(server_url: str, work_dir: str) -> Dict:
+    env = dict(os.environ)
+    env.update({
+        "ALARIS_DOMAIN": f"{server_url}/",
+        "ALARIS_USER": "benchmark",
+        "PASSWORD": "benchmark",
+        "ALARIS_EAPI_DOMAIN": f"{server_url}/{EAPI_PATH}",
+        "ALARIS_EAPI_AUTH": "benchmark",
+        "TG_API_URL": server_url,
+        "TG_TOKEN": "benchmark",
+        "TG_CHAT_ID": "1",
+        "TG_MESSAGES_PER_SECOND": "100",
+        "LOG_DIR": work_dir,
+        "CACHE_DIR": work_dir,
+        "LOG_LEVEL": env.get("LOG_LEVEL") or "INFO",
+    })
+    return env
+
+
+def run_command(args: List[str], env: Dict, work_dir: str) -> Dict:
+    """run main.py with args, return wall time, exit code and peak RSS in MiB"""
+    with open(os.path.join(work_dir, "output.txt"), "wb") as output:
+        started = time.perf_counter()
+        proc = subprocess.Popen(
+            [sys.executable, MAIN, *args], env=env, cwd=work_dir,
+            stdout=output, stderr=subprocess.STDOUT,
+        )
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall_time = time.perf_counter() - started
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return {
+        "wall_time": round(wall_time, 3),
+        "exit_code": proc.returncode,
+        # ru_maxrss is in KiB on linux
+        "peak_rss_mb": round(rusage.ru_maxrss / 1024, 1),
+    }
+
+
+def run_scenario(name: str, latency: float, error_rate: float, tg_429_rate: float) -> Dict:
+    args, tasks, products, mccmnc, rated_products = SCENARIOS[name]
+    state = make_state(
+        tasks, products, mccmnc, rated_products,
+        latency=latency, error_rate=error_rate, tg_429_rate=tg_429_rate,
+    )
+    if args[0] == "rate":
+        args = args + ["--rate-start-date", RATE_PERIOD[0], "--rate-end-date", RATE_PERIOD[1]]
+    with MockServer(state) as server, tempfile.TemporaryDirectory() as work_dir:
+        result = run_command(args, command_env(server.url, work_dir), work_dir)
+        stats = state.stats()
+    result.update({
+        "scenario": name,
+        "requests": stats.get("total", 0),
+        "updated_rates": stats["updated_rates"],
+        "injected_429": stats.get("injected 429", 0),
+        "requests_by_endpoint": {key: value for key, value in stats.items() if key.startswith(("GET", "POST"))},
+    })
+    return result
+
+
+def print_table(results: List[Dict]):
+    header = f"{'scenario':<20} {'exit':>4} {'wall, s':>9} {'requests':>9} {'updated':>8} {'rss, MiB':>9}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            f"{result['scenario']:<20} {result['exit_code']:>4} {result['wall_time']:>9.3f} "
+            f"{result['requests']:>9} {result['updated_rates']:>8} {result['peak_rss_mb']:>9.1f}"
+        )
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description="benchmark main.py commands against a mock server")
+    parser.add_argument("--scenario", nargs="+", choices=sorted(SCENARIOS), default=sorted(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every answer")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="share of alaris and EAPI requests answered with 429")
+    parser.add_argument("--tg-429-rate", type=float, default=0.0,
+                        help="share of telegram messages answered with 429")
+    parser.add_argument("--json", action="store_true", help="print one JSON line per scenario")
+    return parser
+
+
+if __name__ == "__main__":
+    arguments = argument_parser().parse_args()
+    results = []
+    for scenario in arguments.scenario:
+        result = run_scenario(scenario, arguments.latency, arguments.error_rate, arguments.tg_429_rate)
+        results.append(result)
+        if arguments.json:
+            print(json.dumps(result), flush=True)
+    if not arguments.json:
+        print_table(results)
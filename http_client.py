@@ -0,0 +1,134 @@
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from logger import create_logger
+from metrics import metrics
+from settings import settings
+
+logger = create_logger(__name__, 'http_client.log')
+
+HTTP_POOL_SIZE = settings.http_pool_size
+HTTP_MAX_RETRIES = settings.http_max_retries
+HTTP_BACKOFF_FACTOR = settings.http_backoff_factor
+HTTP_CONNECT_TIMEOUT = settings.http_connect_timeout
+HTTP_READ_TIMEOUT = settings.http_read_timeout
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# other methods, e.g. sms_rate upload POST, are retried only when the request
+# surely was not processed: on connect errors and on UNPROCESSED_STATUSES
+RETRY_METHODS = Retry.DEFAULT_ALLOWED_METHODS
+UNPROCESSED_STATUSES = (429,)
+# for POST endpoints which are safe to repeat, e.g. EAPI JSON-RPC reads
+POST_RETRY_METHODS = frozenset(RETRY_METHODS | {'POST'})
+
+
+class JitteredRetry(Retry):
+    """Retry with exponential backoff and full jitter"""
+
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        if not backoff:
+            return 0
+        return random.uniform(0, backoff)
+
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        # urllib3 retries connect errors for any method, but statuses only for allowed ones
+        if status_code in UNPROCESSED_STATUSES and status_code in (self.status_forcelist or ()):
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def make_retry(total: int = HTTP_MAX_RETRIES, backoff_factor: float = HTTP_BACKOFF_FACTOR,
+               statuses=RETRY_STATUSES, methods=RETRY_METHODS) -> Retry:
+    return JitteredRetry(
+        total=total,
+        connect=total,
+        read=total,
+        status=total,
+        backoff_factor=backoff_factor,
+        status_forcelist=statuses,
+        allowed_methods=methods,
+        respect_retry_after_header=True,
+        # let caller get the last response and call raise_for_status() on it
+        raise_on_status=False,
+    )
+
+
+class HttpClient(requests.Session):
+    """
+    Session with a tuned connection pool, retries, per-endpoint timeouts
+    and per-call latency records.
+
+    timeouts maps endpoint name (a segment of the url path, e.g. 'product')
+    to (connect, read) timeout. Endpoints without an entry use the default
+    HTTP_CONNECT_TIMEOUT/HTTP_READ_TIMEOUT.
+    """
+
+    def __init__(self, timeouts: Dict[str, Tuple[float, float]] = None,
+                 pool_size: int = HTTP_POOL_SIZE, retry: Retry = None):
+        super().__init__()
+        self.timeouts = timeouts or {}
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=retry or make_retry(),
+        )
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def endpoint_name(self, url: str) -> str:
+        for segment in reversed(urlparse(url).path.split('/')):
+            if segment and not segment.isdigit():
+                return segment
+        return ''
+
+    def request(self, method, url, *args, **kwargs):
+        endpoint = self.endpoint_name(url)
+        kwargs.setdefault(
+            'timeout',
+            self.timeouts.get(endpoint, (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)),
+        )
+        started = time.perf_counter()
+        try:
+            with metrics.span(f'http.{endpoint}'):
+                resp = super().request(method, url, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.latencies[endpoint].append(elapsed)
+        logger.debug('%s %s %s in %.3fs', method, endpoint, resp.status_code, elapsed)
+        self.count_response(resp, kwargs.get('stream', False))
+        return resp
+
+    def count_response(self, resp: requests.Response, stream: bool):
+        metrics.incr('http_requests')
+        retries = getattr(resp.raw, 'retries', None)
+        if retries is not None and retries.history:
+            metrics.incr('http_retries', len(retries.history))
+        # streamed body is not read here, so only its declared length is known
+        length = resp.headers.get('Content-Length')
+        if length and length.isdigit():
+            metrics.incr('http_bytes_downloaded', int(length))
+        elif not stream:
+            metrics.incr('http_bytes_downloaded', len(resp.content))
+
+    def reset_latencies(self):
+        self.latencies.clear()
+
+    def latency_summary(self) -> Dict[str, Dict[str, float]]:
+        """return calls count, total and max latency in seconds per endpoint"""
+        return {
+            endpoint: {
+                'calls': len(latencies),
+                'total': round(sum(latencies), 3),
+                'max': round(max(latencies), 3),
+            }
+            for endpoint, latencies in self.latencies.items()
+        }
@@ -0,0 +1,151 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+from logger import create_logger
+from settings import settings
+
+logger = create_logger(__name__, "instances.log")
+
+# commands which are run for every instance of ALARIS_INSTANCES_FILE
+FAN_OUT_COMMANDS = ("rate", "rerating-task")
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+
+class InstancesFileError(Exception):
+    pass
+
+
+def load_instances(path: str) -> Dict[str, Dict[str, str]]:
+    """
+    Read instances file: a JSON object which maps instance name to environment
+    variables of the instance, e.g.
+
+        {"msk": {"ALARIS_DOMAIN": "https://msk.example/api/", "ALARIS_USER": "cli",
+                 "PASSWORD": "...", "ALARIS_EAPI_DOMAIN": "...", "HTTP_POOL_SIZE": 4}}
+
+    Variables missing for an instance are taken from the environment and .env.
+    """
+    try:
+        with open(path) as instances_file:
+            instances = json.load(instances_file)
+    except (OSError, ValueError) as err:
+        raise InstancesFileError(f"could not read instances file {path}: {err}") from err
+    if not isinstance(instances, dict) or not instances:
+        raise InstancesFileError(f"{path} should be a JSON object of instances")
+    for name, variables in instances.items():
+        if not isinstance(variables, dict):
+            raise InstancesFileError(f"instance {name!r} in {path} should be a JSON object")
+    return {
+        name: {key: str(value) for key, value in variables.items() if value is not None}
+        for name, variables in instances.items()
+    }
+
+
+def select_instances(instances: Dict[str, Dict[str, str]],
+                     names: Optional[List[str]]) -> Dict[str, Dict[str, str]]:
+    if not names:
+        return instances
+    unknown = [name for name in names if name not in instances]
+    if unknown:
+        raise InstancesFileError(f"unknown instances {unknown}, expected some of {list(instances)}")
+    return {name: instances[name] for name in names}
+
+
+def instance_env(name: str, variables: Dict[str, str]) -> Dict[str, str]:
+    """
+    environment of the instance process.
+
+    Every instance keeps token, reference caches, watermark and logs in its own
+    directory under CACHE_DIR/LOG_DIR unless the instance sets them.
+    """
+    env = dict(os.environ)
+    env.update(variables)
+    env["ALARIS_INSTANCE"] = name
+    # output is forwarded line by line, so do not keep it in the child buffers
+    env["PYTHONUNBUFFERED"] = "1"
+    if "CACHE_DIR" not in variables:
+        env["CACHE_DIR"] = os.path.join(settings.cache_dir or settings.log_dir or os.getcwd(), name)
+    if "LOG_DIR" not in variables and settings.log_dir:
+        env["LOG_DIR"] = os.path.join(settings.log_dir, name)
+    for key in ("CACHE_DIR", "LOG_DIR"):
+        if env.get(key):
+            os.makedirs(env[key], exist_ok=True)
+    return env
+
+
+class OutputMerger:
+    """
+    Write lines of several processes to stdout/stderr prefixed by instance name.
+
+    With raw=True lines are written as they are, e.g. JSON lines or CSV rows
+    which have the instance column, and the CSV header is written only once.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.headers = set()
+
+    def forward(self, name: str, pipe, target, raw: bool = False):
+        first = True
+        for line in iter(pipe.readline, b""):
+            text = line.decode(errors="replace").rstrip("\n")
+            with self.lock:
+                if not raw:
+                    print(f"[{name}] {text}", file=target, flush=True)
+                elif not (first and text in self.headers):
+                    if first:
+                        self.headers.add(text)
+                    print(text, file=target, flush=True)
+            first = False
+        pipe.close()
+
+
+def run_instances(instances: Dict[str, Dict[str, str]], argv: List[str],
+                  raw_stdout: bool = False) -> int:
+    """
+    Run main.py with argv for every instance concurrently and merge their output.
+
+    Each instance is a separate process with its own settings, sessions, token
+    cache and limits, so a slow instance does not delay output or notifications
+    of the others. With raw_stdout stdout lines are not prefixed, see OutputMerger.
+    Returns 0 if all instances succeeded, otherwise 1.
+    """
+    merger = OutputMerger()
+    processes = {}
+    forwarders = []
+    started = time.perf_counter()
+    for name, variables in instances.items():
+        logger.info("start instance %s", name)
+        proc = subprocess.Popen(
+            [sys.executable, MAIN, *argv], env=instance_env(name, variables),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        processes[name] = proc
+        outputs = ((proc.stdout, sys.stdout, raw_stdout), (proc.stderr, sys.stderr, False))
+        for pipe, target, raw in outputs:
+            forwarder = threading.Thread(
+                target=merger.forward, args=(name, pipe, target, raw), daemon=True
+            )
+            forwarder.start()
+            forwarders.append(forwarder)
+    failed = []
+    for name, proc in processes.items():
+        returncode = proc.wait()
+        logger.info(
+            "instance %s finished with code %s in %.3fs",
+            name, returncode, time.perf_counter() - started,
+        )
+        if returncode != 0:
+            failed.append(name)
+    for forwarder in forwarders:
+        forwarder.join()
+    if failed:
+        logger.warning("instances %s failed", failed)
+        print(f"instances failed: {', '.join(failed)}", file=sys.stderr)
+        return 1
+    return 0
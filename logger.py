@@ -1,11 +1,11 @@
+import atexit
 import logging
 import os
-import sys
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-from dotenv import load_dotenv
-
-
-load_dotenv()
+from settings import settings
 
 LOG_LEVELS = {
         'DEBUG': logging.DEBUG,
@@ -13,24 +13,99 @@ LOG_LEVELS = {
         'WARNING': logging.WARNING,
         'ERROR': logging.ERROR,
     }
+LOG_MAX_BYTES = settings.log_max_bytes
+LOG_BACKUP_COUNT = settings.log_backup_count
+
+
+class RoutingHandler(logging.Handler):
+    """
+    Write records to the file of the logger they came from.
+
+    Used by the single QueueListener thread, so files are written by one thread only.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.routes = {}
+        self.file_handlers = {}
+
+    def add_route(self, logger_name, log_file):
+        handler = self.file_handlers.get(log_file)
+        if handler is None:
+            handler = RotatingFileHandler(
+                filename=log_file,
+                maxBytes=LOG_MAX_BYTES,
+                backupCount=LOG_BACKUP_COUNT,
+                delay=True,
+            )
+            handler.setFormatter(logging.Formatter(
+                "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+            ))
+            self.file_handlers[log_file] = handler
+        self.routes[logger_name] = handler
+
+    def emit(self, record):
+        handler = self.routes.get(record.name)
+        if handler is not None:
+            handler.handle(record)
+
+    def close(self):
+        for handler in self.file_handlers.values():
+            handler.close()
+        super().close()
+
+
+class LazyQueueHandler(QueueHandler):
+    """QueueHandler which starts the writer thread with the first record"""
+
+    def enqueue(self, record):
+        start_listener()
+        super().enqueue(record)
+
+
+log_queue = queue.SimpleQueue()
+queue_handler = LazyQueueHandler(log_queue)
+routing_handler = RoutingHandler()
+listener = None
+setup_lock = threading.Lock()
+
+
+def start_listener():
+    global listener
+    if listener is not None:
+        return
+    with setup_lock:
+        if listener is None:
+            listener = QueueListener(log_queue, routing_handler)
+            listener.start()
+            atexit.register(stop_listener)
+
+
+def stop_listener():
+    """write all queued records and stop the writer thread"""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+        routing_handler.close()
 
 
 def create_logger(logger_name, filename):
-    log_dir = os.getenv('LOG_DIR')
-    log_file = os.path.join(log_dir, filename)
-    env_log_level = os.getenv('LOG_LEVEL')
-    if env_log_level not in LOG_LEVELS.keys():
-        print(f'unexpected log level. Please provide value from {LOG_LEVELS.keys()}')
-        sys.exit()
-
-    log_level = LOG_LEVELS[env_log_level]
-    logger = logging.getLogger(logger_name)
-    file_handler = logging.FileHandler(filename=log_file)
-    file_formatter = logging.Formatter(
-        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-    )
+    """
+    Return logger which writes to filename in LOG_DIR.
 
-    file_handler.setFormatter(file_formatter)
-    logger.addHandler(file_handler)
+    Records are put into a queue and written by one background thread into
+    rotating files. The thread is started and the file is opened with the first
+    record, so creating loggers at import is cheap. Calling it again for the same
+    logger does not add handlers. Unknown LOG_LEVEL is reported by main.py,
+    here it falls back to INFO.
+    """
+    log_file = os.path.join(settings.log_dir or '', filename)
+    log_level = LOG_LEVELS.get(settings.log_level, logging.INFO)
+    logger = logging.getLogger(logger_name)
+    with setup_lock:
+        routing_handler.add_route(logger_name, log_file)
+        if queue_handler not in logger.handlers:
+            logger.addHandler(queue_handler)
     logger.setLevel(log_level)
     return logger
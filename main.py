@@ -1,61 +1,300 @@
+import time
+
+STARTED = time.perf_counter()
+
+from settings import LOG_LEVEL_NAMES, settings
+
+SETTINGS_LOADED = time.perf_counter()
+
 import argparse
+import html
+import importlib
+import json
+import signal
 import sys
+import threading
 
 from datetime import timedelta, datetime
 
 from logger import create_logger
-from sms_update_rate import update_sms_rate
-from sms_rerating_task import main as get_rerating_task
-from telegram_notify import send_rerating_notification, send_tg_message
-from alaris_enterprise_api import EAPIError
+from metrics import metrics
 
 logger = create_logger(__name__, "main.log")
+# seconds spent in startup phases, command modules are imported on dispatch
+startup_timings = {
+    "settings": SETTINGS_LOADED - STARTED,
+    "main imports": time.perf_counter() - SETTINGS_LOADED,
+}
+
+
+def import_command_module(name):
+    """import module of a command when it is run and record the import time"""
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    startup_timings.setdefault(f"import {name}", time.perf_counter() - started)
+    return module
+
+
+def open_record_writer(arguments, kind):
+    """return record_writer.RecordWriter of tasks or rates for --output/--output-file or None"""
+    if not arguments.output and not arguments.output_file:
+        return None
+    record_writer = import_command_module("record_writer")
+    return record_writer.RecordWriter(
+        record_writer.RECORD_FIELDS[kind],
+        fmt=record_writer.output_format(arguments.output, arguments.output_file),
+        path=arguments.output_file,
+    )
 
 
 def sms_rate_update_callback(arguments):
     logger.info("start update rate command")
     logger.info(arguments)
+    products = parse_products(arguments)
+    sms_update_rate = import_command_module("sms_update_rate")
+    eapi = import_command_module("alaris_enterprise_api")
+    telegram_notify = import_command_module("telegram_notify")
+    writer = open_record_writer(arguments, "rates")
+    update_kwargs = dict(
+        rate_start_date=arguments.rate_start_date,
+        rate_end_date=arguments.rate_end_date,
+        products=products,
+        codes=arguments.codes,
+        batch_size=arguments.batch_size,
+        workers=arguments.workers,
+        dry_run=arguments.dry_run,
+        from_store=arguments.from_store,
+        rate_sink=writer.write if writer else None,
+    )
     try:
-        update_report = update_sms_rate(
-            rate_start_date=arguments.rate_start_date,
-            rate_end_date=arguments.rate_end_date,
-            codes=arguments.codes,
+        if arguments.use_async:
+            import asyncio
+
+            update_report = asyncio.run(sms_update_rate.update_sms_rate_async(**update_kwargs))
+        else:
+            update_report = sms_update_rate.update_sms_rate(**update_kwargs)
+    except eapi.EAPIError as err:
+        logger.exception("get error from Enterprise API during retrieve rates\n%s", err)
+        telegram_notify.send_tg_text(
+            f"{telegram_notify.instance_header()}"
+            f"get error from Enterprise API during retrieve rates\n{html.escape(str(err))}"
         )
-    except EAPIError as err:
-        logger.exception(f"get error from Enterprise API during retrieve rates\n{err}")
-        send_tg_message(f"get error from Enterprise API during retrieve rates\n{err}")
-        sys.exit()
-    if arguments.notify:
+        sys.exit(f"get error from Enterprise API during retrieve rates\n{err}")
+    finally:
+        if writer:
+            writer.close()
+    if arguments.notify and not arguments.dry_run:
+        products_caption = ", ".join(products) or "Retail Demo Client Premium"
+        # the full report repeats every chunk and could be far over the telegram limit
+        logger.info("update report: %s", update_report)
         message = (
-            "Completed updating rate for product Retail Demo Client Premium\n"
-            f"{update_report}"
+            f"{telegram_notify.instance_header()}"
+            f"Completed updating rate for products {html.escape(products_caption)}\n"
+            f"{html.escape(sms_update_rate.report_summary(update_report))}"
         )
-        send_tg_message(message)
+        telegram_notify.send_tg_text(message)
+    elif writer:
+        # rate rows are in the output, the report repr could be huge in dry run
+        logger.info("update report: %s", update_report)
+        logger.info("wrote %s rate rows to %s", writer.count, writer.path or "stdout")
     else:
         print(update_report, file=sys.stderr)
     logger.info("finished update rate command")
 
 
+def parse_products(arguments):
+    products = [
+        product for value in arguments.products or [] for product in value.split(",") if product
+    ]
+    if arguments.products_file:
+        sms_update_rate = import_command_module("sms_update_rate")
+        products.extend(sms_update_rate.read_products_file(arguments.products_file))
+    return products
+
+
+def rates_snapshot_callback(arguments):
+    logger.info("start rates snapshot command")
+    logger.info(arguments)
+    products = parse_products(arguments) or ["14023"]
+    mccmnc = ",".join(arguments.codes or [])
+    rate_store = import_command_module("rate_store")
+    eapi = import_command_module("alaris_enterprise_api")
+    started = time.perf_counter()
+    try:
+        with rate_store.RateStore() as store:
+            report = store.sync(
+                products, arguments.rate_start_date, arguments.rate_end_date, mccmnc,
+                full=arguments.full,
+            )
+    except eapi.EAPIError as err:
+        logger.exception("get error from Enterprise API during retrieve rates\n%s", err)
+        sys.exit(f"get error from Enterprise API during retrieve rates\n{err}")
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    print(report, file=sys.stderr)
+    logger.info("finished rates snapshot command: %s", report)
+
+
+def rates_query_callback(arguments):
+    rate_store = import_command_module("rate_store")
+    started = time.perf_counter()
+    with rate_store.RateStore() as store:
+        rates = store.query(
+            arguments.product,
+            mccmnc=[code for value in arguments.codes or [] for code in value.split(",") if code],
+            on_date=arguments.on_date,
+            start_date=arguments.start_date,
+            end_date=arguments.end_date,
+        )
+    logger.info("found %s rates in %.3fms", len(rates), (time.perf_counter() - started) * 1000)
+    for rate in rates:
+        print(json.dumps(rate))
+
+
+def handle_rerating_tasks(arguments, rerating_tasks) -> int:
+    """
+    print or send tasks as they come from the pipeline, return number of tasks.
+
+    With --output/--output-file tasks are written there as they come, and also
+    sent with --notify.
+    """
+    writer = open_record_writer(arguments, "tasks")
+    try:
+        if writer:
+            rerating_tasks = writer.write_all(rerating_tasks, convert=lambda task: task.as_dict())
+        if arguments.notify:
+            telegram_notify = import_command_module("telegram_notify")
+            return telegram_notify.send_rerating_notification(rerating_tasks)
+        count = 0
+        for task in rerating_tasks:
+            if not writer:
+                print(task.as_dict(), file=sys.stderr)
+            count += 1
+        return count
+    finally:
+        if writer:
+            writer.close()
+
+
 def rerating_task_callback(arguments):
     logger.info("start rerating command")
-    rerating_tasks = list(get_rerating_task(arguments.time_shift))
-    logger.debug(rerating_tasks)
-    if not arguments.notify:
-        for task in rerating_tasks:
-            print(task, file=sys.stderr)
+    sms_rerating_task = import_command_module("sms_rerating_task")
+    if arguments.use_async:
+        import asyncio
+
+        rerating_tasks = asyncio.run(
+            sms_rerating_task.main_async(
+                arguments.time_shift,
+                refresh_cache=arguments.refresh_cache,
+                incremental=arguments.incremental,
+                columnar=arguments.columnar,
+            )
+        )
     else:
-        send_rerating_notification(rerating_tasks)
+        rerating_tasks = sms_rerating_task.main(
+            arguments.time_shift,
+            refresh_cache=arguments.refresh_cache,
+            incremental=arguments.incremental,
+            columnar=arguments.columnar,
+        )
+    handle_rerating_tasks(arguments, rerating_tasks)
     logger.info("finished rerating command")
 
 
+def rerating_watch_callback(arguments):
+    """poll rerating tasks every --interval seconds until SIGTERM/SIGINT"""
+    logger.info("start rerating watch command")
+    if arguments.output or arguments.output_file:
+        sys.exit("--output and --output-file are supported by rate and rerating-task only")
+    sms_rerating_task = import_command_module("sms_rerating_task")
+    stop = threading.Event()
+
+    def request_stop(signum, _frame):
+        logger.info("got signal %s, stop after current tick", signum)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    refresh_cache = arguments.refresh_cache
+    while not stop.is_set():
+        started = time.perf_counter()
+        handled = 0
+        try:
+            handled = handle_rerating_tasks(
+                arguments,
+                sms_rerating_task.main(
+                    arguments.time_shift, refresh_cache=refresh_cache, incremental=True
+                ),
+            )
+        except Exception:
+            logger.exception("rerating watch tick failed")
+        refresh_cache = False
+        elapsed = time.perf_counter() - started
+        logger.info("tick finished in %.3fs, tasks: %s", elapsed, handled)
+        metrics.export(arguments.metrics_file, command="watch")
+        metrics.reset()
+        stop.wait(max(arguments.interval - elapsed, 0))
+    logger.info("finished rerating watch command")
+
+
 def argument_parser():
     parser = argparse.ArgumentParser(
         description="collection of commands for working with sms"
     )
     sub_parser = parser.add_subparsers(
         help="list of allowed commands",
+        dest="command",
     )
     parser.add_argument("--notify", required=False, type=bool, default=False)
+    parser.add_argument(
+        "--metrics-file",
+        dest="metrics_file",
+        required=False,
+        help="write timings and counters of the run to this file: prometheus textfile "
+        "if it ends with .prom, otherwise a JSON line is appended. Default METRICS_FILE",
+    )
+    parser.add_argument(
+        "--startup-timing",
+        dest="startup_timing",
+        action="store_true",
+        help="print time spent in loading settings and imports before the command",
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        required=False,
+        help="write cProfile stats of the run to this file, "
+        "read them with python -m pstats <file>",
+    )
+    parser.add_argument(
+        "--output",
+        dest="output",
+        required=False,
+        choices=("jsonl", "csv"),
+        help="write rerating tasks or updated rate rows as they are produced in this format "
+        "to --output-file or stdout. Default is guessed from --output-file name, jsonl",
+    )
+    parser.add_argument(
+        "--output-file",
+        dest="output_file",
+        required=False,
+        help="file for --output records, gzipped if the name ends with .gz",
+    )
+    parser.add_argument(
+        "--instances-file",
+        dest="instances_file",
+        required=False,
+        help="JSON file with environment of several alaris instances, rate and "
+        "rerating-task are run for all of them concurrently. Default ALARIS_INSTANCES_FILE, "
+        "which is used by rate and rerating-task only",
+    )
+    parser.add_argument(
+        "--instance",
+        dest="instances",
+        required=False,
+        type=lambda names: [name.strip() for name in names.split(",") if name.strip()],
+        help="comma separated names of instances from --instances-file to run the command for. "
+        "Default all",
+    )
     rate_cmd = sub_parser.add_parser(
         "rate",
         help="Set to zero rates and rate_close_date set to --rate-end-date"
@@ -82,8 +321,142 @@ def argument_parser():
         nargs="+",
         help="comma separated mccmnc list for filtering rate",
     )
+    rate_cmd.add_argument(
+        "--products",
+        dest="products",
+        required=False,
+        nargs="+",
+        help="product ids for rate update. Default 14023 (Retail Demo Client Premium)",
+    )
+    rate_cmd.add_argument(
+        "--products-file",
+        dest="products_file",
+        required=False,
+        help="file with product ids separated by new lines or commas",
+    )
+    rate_cmd.add_argument(
+        "--batch-size",
+        dest="batch_size",
+        required=False,
+        type=int,
+        help="count of rates uploaded in one request. Default RATE_UPDATE_BATCH_SIZE or 200",
+    )
+    rate_cmd.add_argument(
+        "--workers",
+        dest="workers",
+        required=False,
+        type=int,
+        help="count of parallel upload requests. Default RATE_UPDATE_WORKERS or 4",
+    )
+    rate_cmd.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        action="store_true",
+        help="print rates which would be changed without updating them",
+    )
+    rate_cmd.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="run requests concurrently with asyncio and httpx",
+    )
+    rate_cmd.add_argument(
+        "--from-store",
+        dest="from_store",
+        action="store_true",
+        help="compare with rates from the local store synced by rates snapshot "
+        "instead of requesting them from Enterprise API",
+    )
     rate_cmd.set_defaults(callback=sms_rate_update_callback)
 
+    rates_cmd = sub_parser.add_parser(
+        "rates",
+        help="local store of raw sms rates for fast lookups",
+    )
+    rates_sub_parser = rates_cmd.add_subparsers(
+        help="rates store commands",
+        dest="rates_command",
+        metavar="{snapshot,query}",
+        required=True,
+    )
+    snapshot_cmd = rates_sub_parser.add_parser(
+        "snapshot",
+        help="download raw rates of products from Enterprise API into the local store. "
+        "Windows synced less than RATE_STORE_TTL seconds ago are skipped",
+    )
+    snapshot_cmd.add_argument(
+        "--rate-start-date",
+        dest="rate_start_date",
+        required=False,
+        default=datetime.now().replace(day=1).strftime("%Y-%m-%d"),
+        help="rate start date in format YYYY-MM-DD. Default value first date of current month.",
+    )
+    snapshot_cmd.add_argument(
+        "--rate-end-date",
+        dest="rate_end_date",
+        required=False,
+        default=datetime.now().strftime("%Y-%m-%d"),
+        help="rate end date in format YYYY-MM-DD. Default value current day",
+    )
+    snapshot_cmd.add_argument(
+        "--mccmnc-list",
+        dest="codes",
+        required=False,
+        nargs="+",
+        help="comma separated mccmnc list for filtering rate",
+    )
+    snapshot_cmd.add_argument(
+        "--products",
+        dest="products",
+        required=False,
+        nargs="+",
+        help="product ids to sync. Default 14023 (Retail Demo Client Premium)",
+    )
+    snapshot_cmd.add_argument(
+        "--products-file",
+        dest="products_file",
+        required=False,
+        help="file with product ids separated by new lines or commas",
+    )
+    snapshot_cmd.add_argument(
+        "--full",
+        dest="full",
+        action="store_true",
+        help="download all windows of the period again",
+    )
+    snapshot_cmd.set_defaults(callback=rates_snapshot_callback)
+    query_cmd = rates_sub_parser.add_parser(
+        "query",
+        help="print stored rates of a product as JSON lines",
+    )
+    query_cmd.add_argument("--product", dest="product", required=True, help="product id")
+    query_cmd.add_argument(
+        "--mccmnc",
+        dest="codes",
+        required=False,
+        nargs="+",
+        help="mccmnc codes, by default all",
+    )
+    query_cmd.add_argument(
+        "--date",
+        dest="on_date",
+        required=False,
+        help="return rates valid on date in format YYYY-MM-DD",
+    )
+    query_cmd.add_argument(
+        "--start-date",
+        dest="start_date",
+        required=False,
+        help="return rates overlapping the period from this date in format YYYY-MM-DD",
+    )
+    query_cmd.add_argument(
+        "--end-date",
+        dest="end_date",
+        required=False,
+        help="return rates overlapping the period till this date in format YYYY-MM-DD",
+    )
+    query_cmd.set_defaults(callback=rates_query_callback)
+
     rerating_task_cmd = sub_parser.add_parser(
         "rerating-task",
         help="return manual created rerating tasks that were updated. "
@@ -98,10 +471,135 @@ def argument_parser():
         type=lambda d: timedelta(minutes=int(d)),
         default=timedelta(minutes=1),
     )
+    rerating_task_cmd.add_argument(
+        "--refresh-cache",
+        dest="refresh_cache",
+        action="store_true",
+        help="ignore cached products, carriers and accounts and download them again",
+    )
+    rerating_task_cmd.add_argument(
+        "--columnar",
+        dest="columnar",
+        action="store_true",
+        help="download the whole task list and filter it by update time with NumPy in one "
+        "batch, faster for very large lists. Not used with --incremental",
+    )
+    rerating_task_cmd.add_argument(
+        "--incremental",
+        dest="incremental",
+        action="store_true",
+        help="fetch tasks updated since the previous run instead of the last --time-shift "
+        "minutes. --time-shift is used only for the first run",
+    )
+    rerating_task_cmd.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="run requests concurrently with asyncio and httpx",
+    )
     rerating_task_cmd.set_defaults(callback=rerating_task_callback)
+
+    watch_cmd = sub_parser.add_parser(
+        "watch",
+        help="run rerating-task in a loop every --interval seconds until SIGTERM. "
+        "Tasks are fetched incrementally, auth token, connections and reference data "
+        "are kept between ticks",
+    )
+    watch_cmd.add_argument(
+        "--interval",
+        help="seconds between polls",
+        dest="interval",
+        required=False,
+        type=int,
+        default=60,
+    )
+    watch_cmd.add_argument(
+        "--time-shift",
+        help="time in minutes before the present time for the first poll",
+        dest="time_shift",
+        required=False,
+        type=lambda d: timedelta(minutes=int(d)),
+        default=timedelta(minutes=1),
+    )
+    watch_cmd.add_argument(
+        "--refresh-cache",
+        dest="refresh_cache",
+        action="store_true",
+        help="download products, carriers and accounts again on the first tick",
+    )
+    watch_cmd.set_defaults(callback=rerating_watch_callback)
     return parser.parse_args()
 
 
+def run_instances(arguments):
+    """
+    run the command for instances of --instances-file in separate processes and
+    return exit code, or None if the command should run in this process.
+    """
+    instances = import_command_module("instances")
+    if arguments.command not in instances.FAN_OUT_COMMANDS:
+        if arguments.instances_file or arguments.instances:
+            sys.exit(f"{arguments.command} could not be run for several instances, "
+                     f"supported commands: {', '.join(instances.FAN_OUT_COMMANDS)}")
+        # ALARIS_INSTANCES_FILE from the environment does not apply to other commands
+        return None
+    instances_file = arguments.instances_file or settings.alaris_instances_file
+    if not instances_file:
+        sys.exit("--instance needs --instances-file or ALARIS_INSTANCES_FILE")
+    try:
+        selected = instances.select_instances(
+            instances.load_instances(instances_file), arguments.instances
+        )
+    except instances.InstancesFileError as err:
+        sys.exit(str(err))
+    logger.info("run %s for instances %s", arguments.command, list(selected))
+    return instances.run_instances(
+        selected, sys.argv[1:], raw_stdout=bool(arguments.output or arguments.output_file)
+    )
+
+
+def print_startup_timing():
+    """print startup phases in milliseconds, with -X importtime for details of imports"""
+    for phase, seconds in startup_timings.items():
+        print(f"{phase:<40} {seconds * 1000:>9.1f} ms", file=sys.stderr)
+
+
+def run_command(arguments):
+    """run command callback, optionally under cProfile, and export metrics of the run"""
+    if not settings.log_level_is_valid:
+        sys.exit(f"unexpected log level {settings.log_level!r}. Please provide value from {LOG_LEVEL_NAMES}")
+    startup_timings["arguments"] = time.perf_counter() - STARTED - sum(startup_timings.values())
+    # instance processes get ALARIS_INSTANCE and run the command themselves
+    fan_out = arguments.instances_file or arguments.instances or settings.alaris_instances_file
+    if fan_out and not settings.alaris_instance:
+        exit_code = run_instances(arguments)
+        if exit_code is not None:
+            sys.exit(exit_code)
+    if arguments.profile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+    else:
+        profiler = None
+    try:
+        if profiler is None:
+            arguments.callback(arguments)
+        else:
+            profiler.runcall(arguments.callback, arguments)
+    finally:
+        if profiler is not None:
+            profiler.dump_stats(arguments.profile)
+            logger.info("profile stats written to %s", arguments.profile)
+        for phase, seconds in startup_timings.items():
+            metrics.observe(f"startup.{phase.replace(' ', '_')}", seconds)
+        logger.info("run metrics: %s", metrics.to_json_line(command=arguments.command))
+        # watch exports metrics of every tick by itself
+        if arguments.command != "watch":
+            metrics.export(arguments.metrics_file, command=arguments.command)
+        if arguments.startup_timing:
+            print_startup_timing()
+
+
 if __name__ == "__main__":
     args = argument_parser()
-    args.callback(args)
+    run_command(args)
@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator
+
+
+from logger import create_logger
+from settings import settings
+
+logger = create_logger(__name__, 'metrics.log')
+
+# file with metrics of every run: *.prom is written as prometheus textfile,
+# any other file gets one JSON line appended per run
+METRICS_FILE = settings.metrics_file
+METRICS_PREFIX = 'alaris_cli'
+# runs for an instance of ALARIS_INSTANCES_FILE are labeled with its name
+METRICS_INSTANCE = settings.alaris_instance
+
+
+class Metrics:
+    """
+    Timing spans and counters of one run.
+
+    A span records calls, total and max seconds and self seconds, i.e. total
+    without the time of spans opened inside it in the same thread. So spans
+    around stages of a lazy generator pipeline (see timed_iter) show how much
+    time every stage took by itself.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.spans: Dict[str, Dict[str, float]] = {}
+        self.counters: Dict[str, float] = {}
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.spans.clear()
+            self.counters.clear()
+
+    def incr(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float, self_seconds: float = None):
+        with self.lock:
+            span = self.spans.setdefault(name, {'calls': 0, 'total': 0.0, 'self': 0.0, 'max': 0.0})
+            span['calls'] += 1
+            span['total'] += seconds
+            span['self'] += seconds if self_seconds is None else self_seconds
+            span['max'] = max(span['max'], seconds)
+
+    @contextmanager
+    def span(self, name: str):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        # time of nested spans is collected into the last item
+        stack.append(0.0)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.observe(name, elapsed, elapsed - nested)
+
+    def timed_iter(self, name: str, items: Iterable, counter: str = None) -> Iterator:
+        """
+        yield items and record time spent in getting each of them as span name,
+        with counter every yielded item is counted.
+        """
+        iterator = iter(items)
+        while True:
+            with self.span(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            if counter:
+                self.incr(counter)
+            yield item
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return {
+                'started': round(self.started, 3),
+                'duration': round(time.time() - self.started, 3),
+                'spans': {
+                    name: {key: round(value, 6) for key, value in span.items()}
+                    for name, span in self.spans.items()
+                },
+                'counters': dict(self.counters),
+            }
+
+    def to_json_line(self, **labels) -> str:
+        return json.dumps(dict(labels, **self.snapshot()), sort_keys=True)
+
+    def to_prometheus(self, **labels) -> str:
+        snapshot = self.snapshot()
+
+        def metric_labels(**extra):
+            pairs = dict(labels, **extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in sorted(pairs.items())) + '}'
+
+        lines = [
+            f'# TYPE {METRICS_PREFIX}_run_started_seconds gauge',
+            f'{METRICS_PREFIX}_run_started_seconds{metric_labels()} {snapshot["started"]}',
+            f'# TYPE {METRICS_PREFIX}_run_duration_seconds gauge',
+            f'{METRICS_PREFIX}_run_duration_seconds{metric_labels()} {snapshot["duration"]}',
+        ]
+        for key in ('calls', 'total', 'self', 'max'):
+            metric = f'{METRICS_PREFIX}_span_{key}' if key == 'calls' else f'{METRICS_PREFIX}_span_{key}_seconds'
+            lines.append(f'# TYPE {metric} gauge')
+            for name, span in sorted(snapshot['spans'].items()):
+                lines.append(f'{metric}{metric_labels(span=name)} {span[key]}')
+        lines.append(f'# TYPE {METRICS_PREFIX}_counter gauge')
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f'{METRICS_PREFIX}_counter{metric_labels(name=name)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path: str = None, **labels):
+        """write metrics to path, see METRICS_FILE. Nothing is done without path"""
+        path = path or METRICS_FILE
+        if not path:
+            return
+        if METRICS_INSTANCE:
+            labels.setdefault('instance', METRICS_INSTANCE)
+            if path.endswith('.prom'):
+                # every instance process keeps its own textfile
+                path = f'{path[:-len(".prom")]}_{METRICS_INSTANCE}.prom'
+        try:
+            if path.endswith('.prom'):
+                # textfile collector could read the file at any moment, so replace it at once
+                tmp_path = f'{path}.tmp'
+                with open(tmp_path, 'w') as metrics_file:
+                    metrics_file.write(self.to_prometheus(**labels))
+                os.replace(tmp_path, path)
+            else:
+                with open(path, 'a') as metrics_file:
+                    metrics_file.write(self.to_json_line(**labels) + '\n')
+        except OSError as err:
+            logger.warning('could not write metrics to %s: %s', path, err)
+
+
+metrics = Metrics()
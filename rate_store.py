@@ -0,0 +1,274 @@
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+from logger import create_logger
+from metrics import metrics
+from settings import settings
+
+logger = create_logger(__name__, "rate_store.log")
+
+RATE_STORE_FILE = settings.rate_store_file or settings.cache_path("sms_rates.sqlite3")
+# windows synced less than RATE_STORE_TTL seconds ago are not requested again
+RATE_STORE_TTL = settings.rate_store_ttl
+# keys of product id and rate period in rows of EAPI get_raw_sms_rate_list
+RAW_RATE_PRODUCT_KEY = "product_id"
+RATE_START_DATE_KEYS = ("rate_start_date", "start_date")
+RATE_END_DATE_KEYS = ("rate_end_date", "end_date")
+# end date of rates without one
+OPEN_END_DATE = "9999-12-31"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rates (
+    product_id INTEGER NOT NULL,
+    mccmnc TEXT NOT NULL,
+    start_date TEXT NOT NULL,
+    end_date TEXT NOT NULL,
+    rate REAL,
+    raw TEXT NOT NULL,
+    PRIMARY KEY (product_id, mccmnc, start_date, end_date)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS rates_by_period ON rates (product_id, start_date, end_date);
+CREATE TABLE IF NOT EXISTS synced_windows (
+    product_id INTEGER NOT NULL,
+    mccmnc_list TEXT NOT NULL,
+    start_date TEXT NOT NULL,
+    end_date TEXT NOT NULL,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (product_id, mccmnc_list, start_date, end_date)
+);
+"""
+
+
+def has_product_keys(rates: List[Dict]) -> bool:
+    """check that rows of a query for several products tell their product"""
+    return all(RAW_RATE_PRODUCT_KEY in rate for rate in rates)
+
+
+def rate_date(rate: Dict, keys) -> str:
+    """return rate date in YYYY-MM-DD format from the first present key"""
+    for key in keys:
+        value = rate.get(key)
+        if value:
+            return str(value)[:10]
+    return ""
+
+
+class RateStore:
+    """
+    Local SQLite copy of EAPI raw sms rates.
+
+    Rates are keyed by (product, mccmnc, start date, end date), so a rate of a
+    product for an mccmnc and a date or a period is an index lookup. The store
+    remembers which EAPI query windows were synced and when, sync() requests
+    only windows that were not synced within ttl seconds.
+    """
+
+    def __init__(self, path: str = RATE_STORE_FILE, ttl: int = RATE_STORE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def is_synced(self, product_id, start_date: str, end_date: str, mccmnc_list: str = "") -> bool:
+        """check that the window was synced for all or for exactly these mccmnc"""
+        row = self.conn.execute(
+            "SELECT max(synced_at) FROM synced_windows "
+            "WHERE product_id = ? AND mccmnc_list IN ('', ?) AND start_date = ? AND end_date = ?",
+            (int(product_id), mccmnc_list, start_date, end_date),
+        ).fetchone()
+        return row[0] is not None and time.time() - row[0] < self.ttl
+
+    def store_window(self, product_ids: List[str], start_date: str, end_date: str,
+                     mccmnc_list: str, rates: List[Dict]):
+        """
+        replace rates of products overlapping the window with rates received for it.
+        Rates of several products should have RAW_RATE_PRODUCT_KEY.
+        """
+        codes = [code for code in mccmnc_list.split(",") if code]
+        single_product = int(product_ids[0]) if len(product_ids) == 1 else None
+        with self.conn:
+            for product_id in product_ids:
+                query = (
+                    "DELETE FROM rates WHERE product_id = ? AND start_date <= ? AND end_date >= ?"
+                )
+                params = [int(product_id), end_date, start_date]
+                if codes:
+                    query += f" AND mccmnc IN ({','.join('?' * len(codes))})"
+                    params.extend(codes)
+                self.conn.execute(query, params)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO rates VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        single_product or int(rate[RAW_RATE_PRODUCT_KEY]),
+                        str(rate["mccmnc"]),
+                        rate_date(rate, RATE_START_DATE_KEYS),
+                        rate_date(rate, RATE_END_DATE_KEYS) or OPEN_END_DATE,
+                        rate.get("rate"),
+                        json.dumps(rate),
+                    )
+                    for rate in rates
+                ),
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO synced_windows VALUES (?, ?, ?, ?, ?)",
+                (
+                    (int(product_id), mccmnc_list, start_date, end_date, time.time())
+                    for product_id in product_ids
+                ),
+            )
+
+    def is_period_synced(self, products: List[str], start_date: str, end_date: str,
+                         mccmnc_list: str = "") -> bool:
+        import alaris_enterprise_api as eapi
+
+        return all(
+            self.is_synced(product, window_start, window_end, codes)
+            for window_start, window_end, codes in eapi.rate_windows(start_date, end_date, mccmnc_list)
+            for product in products
+        )
+
+    def invalidate(self, product_ids: Iterable):
+        """forget sync times of products, e.g. after their rates were changed"""
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM synced_windows WHERE product_id = ?",
+                ((int(product_id),) for product_id in product_ids),
+            )
+
+    def fetch_window(self, eapi, products: List[str], start_date: str, end_date: str,
+                     mccmnc_list: str) -> List[Tuple[List[str], List[Dict]]]:
+        """
+        return (products, rates) of the window. Rates of several products are
+        requested again one product at a time if their rows do not tell the product.
+        """
+        rates = eapi.get_raw_sms_rates(
+            product=",".join(products), start_date=start_date, end_date=end_date,
+            mccmnc_list=mccmnc_list,
+        )
+        if len(products) == 1 or has_product_keys(rates):
+            return [(products, rates)]
+        logger.warning("raw rates have no %s key, request them per product", RAW_RATE_PRODUCT_KEY)
+        return [
+            (
+                [product],
+                eapi.get_raw_sms_rates(
+                    product=product, start_date=start_date, end_date=end_date, mccmnc_list=mccmnc_list
+                ),
+            )
+            for product in products
+        ]
+
+    def sync(self, products: List[str], start_date: str, end_date: str, mccmnc_list: str = "",
+             full: bool = False, workers: int = None) -> Dict:
+        """
+        Download raw rates of products from EAPI into the store.
+
+        The period is split into EAPI windows (see alaris_enterprise_api.rate_windows),
+        a window is requested only for products which have not synced it within ttl,
+        full=True requests all windows. Returns counts of windows and rates.
+        EAPI client is imported here, so queries do not load the HTTP stack.
+        """
+        import alaris_enterprise_api as eapi
+
+        pending = []
+        for window_start, window_end, codes in eapi.rate_windows(start_date, end_date, mccmnc_list):
+            stale = [
+                product for product in products
+                if full or not self.is_synced(product, window_start, window_end, codes)
+            ]
+            if stale:
+                pending.append((stale, window_start, window_end, codes))
+        logger.info("sync %s windows of products %s", len(pending), products)
+        report = {"windows": len(pending), "rates": 0}
+        with ThreadPoolExecutor(max_workers=workers or eapi.EAPI_WORKERS) as executor:
+            futures = {
+                executor.submit(
+                    self.fetch_window, eapi, stale, window_start, window_end, codes
+                ): (window_start, window_end, codes)
+                for stale, window_start, window_end, codes in pending
+            }
+            for future in as_completed(futures):
+                window_start, window_end, codes = futures[future]
+                for window_products, rates in future.result():
+                    with metrics.span("rate_store.write"):
+                        self.store_window(window_products, window_start, window_end, codes, rates)
+                    report["rates"] += len(rates)
+        metrics.incr("rate_store_synced_rates", report["rates"])
+        return report
+
+    def query(self, product_id, mccmnc: Optional[List[str]] = None, on_date: str = None,
+              start_date: str = None, end_date: str = None) -> List[Dict]:
+        """
+        Return stored rates of product_id valid on on_date or overlapping
+        [start_date, end_date], optionally only for mccmnc codes.
+        """
+        if on_date:
+            start_date = end_date = on_date
+        query = "SELECT product_id, mccmnc, start_date, end_date, rate FROM rates WHERE product_id = ?"
+        params = [int(product_id)]
+        if mccmnc:
+            query += f" AND mccmnc IN ({','.join('?' * len(mccmnc))})"
+            params.extend(str(code) for code in mccmnc)
+        if end_date:
+            query += " AND start_date <= ?"
+            params.append(end_date)
+        if start_date:
+            query += " AND end_date >= ?"
+            params.append(start_date)
+        query += " ORDER BY mccmnc, start_date"
+        with metrics.span("rate_store.query"):
+            return [dict(row) for row in self.conn.execute(query, params)]
+
+    def iter_raw_rates(self, products: List[str], start_date: str, end_date: str,
+                       mccmnc_list: str = "") -> Iterator[Dict]:
+        """yield stored rows like alaris_enterprise_api.iter_raw_sms_rates, with RAW_RATE_PRODUCT_KEY"""
+        codes = [code for code in mccmnc_list.split(",") if code]
+        for product_id in products:
+            query = (
+                "SELECT product_id, raw FROM rates "
+                "WHERE product_id = ? AND start_date <= ? AND end_date >= ?"
+            )
+            params = [int(product_id), end_date, start_date]
+            if codes:
+                query += f" AND mccmnc IN ({','.join('?' * len(codes))})"
+                params.extend(codes)
+            for row in self.conn.execute(query, params):
+                rate = json.loads(row["raw"])
+                rate.setdefault(RAW_RATE_PRODUCT_KEY, row["product_id"])
+                yield rate
+
+
+def stored_raw_rates(products: List[str], start_date: str, end_date: str,
+                     mccmnc_list: str = "") -> List[Dict]:
+    """return raw rates of products from the store, warn if the period was not synced"""
+    with RateStore() as store:
+        if not store.is_period_synced(products, start_date, end_date, mccmnc_list):
+            logger.warning(
+                "rates of %s from %s till %s are not synced or expired, run rates snapshot",
+                products, start_date, end_date,
+            )
+        return list(store.iter_raw_rates(products, start_date, end_date, mccmnc_list))
+
+
+def invalidate_products(products: Iterable):
+    """mark stored rates of products as outdated if the store exists"""
+    if os.path.exists(RATE_STORE_FILE):
+        with RateStore() as store:
+            store.invalidate(products)
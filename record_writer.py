@@ -0,0 +1,108 @@
+import csv
+import gzip
+import json
+import os
+import sys
+import threading
+from typing import Dict, Iterable, Iterator, Optional, Sequence
+
+from settings import settings
+
+OUTPUT_FORMATS = ("jsonl", "csv")
+# write buffer of --output-file, records are flushed in blocks, not per line
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+# runs for an instance of ALARIS_INSTANCES_FILE add its name to records and file names
+OUTPUT_INSTANCE = settings.alaris_instance
+CSV_LIST_SEPARATOR = "; "
+
+TASK_FIELDS = (
+    "task_id", "task_status", "task_start_time", "task_last_uprate_time",
+    "src_product_ids", "dst_product_ids", "rerating_start_time", "rerating_end_time",
+)
+RATE_FIELDS = (
+    "product_id", "mccmnc", "rate_start_date", "rate_end_date", "rate", "status", "error",
+)
+RECORD_FIELDS = {"tasks": TASK_FIELDS, "rates": RATE_FIELDS}
+
+
+def output_format(output: Optional[str], path: Optional[str]) -> str:
+    """return --output format, without it the format is guessed from --output-file name"""
+    if output:
+        return output
+    if path and path.endswith((".csv", ".csv.gz")):
+        return "csv"
+    return "jsonl"
+
+
+def instance_path(path: str, instance: str) -> str:
+    """insert instance name before extensions, e.g. tasks.csv.gz -> tasks_msk.csv.gz"""
+    directory, filename = os.path.split(path)
+    name, dot, extensions = filename.partition(".")
+    return os.path.join(directory, f"{name}_{instance}{dot}{extensions}")
+
+
+class RecordWriter:
+    """
+    Write dict records as JSON lines or CSV rows to a file or stdout.
+
+    Files are written through a large buffer and gzipped if the name ends
+    with .gz. write() could be called from several threads. CSV columns are
+    fields, list values are joined with CSV_LIST_SEPARATOR.
+    """
+
+    def __init__(self, fields: Sequence[str], fmt: str = "jsonl", path: str = None):
+        if fmt not in OUTPUT_FORMATS:
+            raise ValueError(f"unexpected output format {fmt!r}, expected one of {OUTPUT_FORMATS}")
+        self.fmt = fmt
+        self.fields = list(fields)
+        if OUTPUT_INSTANCE:
+            self.fields.insert(0, "instance")
+            if path and path != "-":
+                path = instance_path(path, OUTPUT_INSTANCE)
+        self.path = path if path and path != "-" else None
+        self.lock = threading.Lock()
+        self.count = 0
+        if self.path is None:
+            self.stream = sys.stdout
+        elif self.path.endswith(".gz"):
+            self.stream = gzip.open(self.path, "wt", encoding="utf-8", newline="")
+        else:
+            self.stream = open(
+                self.path, "w", encoding="utf-8", newline="", buffering=OUTPUT_BUFFER_SIZE
+            )
+        self.csv_writer = None
+        if fmt == "csv":
+            self.csv_writer = csv.DictWriter(self.stream, fieldnames=self.fields, extrasaction="ignore")
+            self.csv_writer.writeheader()
+
+    def write(self, record: Dict):
+        if OUTPUT_INSTANCE:
+            record = dict(record, instance=OUTPUT_INSTANCE)
+        with self.lock:
+            if self.csv_writer is None:
+                self.stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+            else:
+                self.csv_writer.writerow({
+                    key: CSV_LIST_SEPARATOR.join(map(str, value)) if isinstance(value, list) else value
+                    for key, value in record.items()
+                })
+            self.count += 1
+
+    def write_all(self, records: Iterable, convert=None) -> Iterator:
+        """write records as they are iterated and yield them further, e.g. to notifications"""
+        for record in records:
+            self.write(convert(record) if convert else record)
+            yield record
+
+    def close(self):
+        with self.lock:
+            if self.path is None:
+                self.stream.flush()
+            else:
+                self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
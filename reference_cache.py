@@ -0,0 +1,251 @@
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+import requests
+
+from alaris_api import get_reference_list, retrieve_account, retrieve_carrier, retrieve_product
+from logger import create_logger
+from metrics import metrics
+from reference_data import ReferenceIndex, TTLCache
+from settings import settings
+
+logger = create_logger(__name__, 'reference_cache.log')
+
+REFERENCE_CACHE_TTL = settings.reference_cache_ttl
+# tasks referencing more products than this load full lists instead of single objects
+REFERENCE_LOOKUP_THRESHOLD = settings.reference_lookup_threshold
+REFERENCE_LRU_SIZE = settings.reference_lru_size
+REFERENCE_LOOKUP_WORKERS = 8
+
+REFERENCE_ENDPOINTS = ('product', 'carrier', 'account')
+
+# entries already read in this process, long running commands do not re-read files
+memory_entries: Dict[str, Dict] = {}
+last_index: Optional[ReferenceIndex] = None
+last_index_lists: tuple = ()
+
+# single objects fetched by LazyReferenceIndex, shared between runs of watch command
+product_lru = TTLCache(REFERENCE_LRU_SIZE, REFERENCE_CACHE_TTL)
+carrier_lru = TTLCache(REFERENCE_LRU_SIZE, REFERENCE_CACHE_TTL)
+account_lru = TTLCache(REFERENCE_LRU_SIZE, REFERENCE_CACHE_TTL)
+
+
+def cache_path(endpoint: str) -> str:
+    return settings.cache_path(f'alaris_{endpoint}_cache.json')
+
+
+def read_cache_entry(endpoint: str) -> Optional[Dict]:
+    if endpoint in memory_entries:
+        return memory_entries[endpoint]
+    try:
+        with open(cache_path(endpoint)) as cache_file:
+            entry = json.load(cache_file)
+        memory_entries[endpoint] = entry
+        return entry
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as err:
+        logger.warning('could not read %s cache, it will be refreshed: %s', endpoint, err)
+        return None
+
+
+def write_cache_entry(endpoint: str, entry: Dict):
+    """keep entry in memory and on disk, the run goes on if the file could not be written"""
+    memory_entries[endpoint] = entry
+    path = cache_path(endpoint)
+    tmp_path = f'{path}.tmp'
+    try:
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(entry, cache_file, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except OSError as err:
+        logger.warning('could not write %s cache %s: %s', endpoint, path, err)
+
+
+def is_fresh(entry: Dict, ttl: int) -> bool:
+    return time.time() - entry['fetched_at'] < ttl
+
+
+def cached_reference_list(endpoint: str, refresh: bool, ttl: int):
+    """return (fresh cached list or None, cache entry for revalidation)"""
+    entry = None if refresh else read_cache_entry(endpoint)
+    if entry is not None and is_fresh(entry, ttl):
+        logger.debug('use cached %s list', endpoint)
+        return entry['data'], entry
+    return None, entry
+
+
+def store_reference_list(endpoint: str, entry: Optional[Dict], data, new_validators: Dict):
+    if data is None:
+        logger.info('%s list was not modified, extend cache lifetime', endpoint)
+        data = entry['data']
+    else:
+        logger.info('downloaded %s list with %s items', endpoint, len(data))
+    write_cache_entry(
+        endpoint,
+        {'fetched_at': time.time(), 'data': data, **new_validators},
+    )
+    return data
+
+
+def load_reference_list(session: requests.Session, endpoint: str, refresh: bool = False,
+                        ttl: int = REFERENCE_CACHE_TTL):
+    """
+    Return reference list for endpoint from the local cache.
+
+    A fresh cache entry is used as is. A stale one is revalidated with
+    ETag/Last-Modified, so the list is only downloaded if it was changed.
+    refresh=True skips the cache and always downloads the full list.
+    """
+    data, entry = cached_reference_list(endpoint, refresh, ttl)
+    if data is not None:
+        metrics.incr('reference_cache_hits')
+        return data
+    validators = entry or {}
+    data, new_validators = get_reference_list(
+        session,
+        endpoint,
+        etag=validators.get('etag'),
+        last_modified=validators.get('last_modified'),
+    )
+    return store_reference_list(endpoint, entry, data, new_validators)
+
+
+async def load_reference_list_async(client, endpoint: str, refresh: bool = False,
+                                    ttl: int = REFERENCE_CACHE_TTL):
+    """load_reference_list for alaris_api_async.AsyncAlarisClient"""
+    data, entry = cached_reference_list(endpoint, refresh, ttl)
+    if data is not None:
+        metrics.incr('reference_cache_hits')
+        return data
+    validators = entry or {}
+    data, new_validators = await client.get_reference_list(
+        endpoint,
+        etag=validators.get('etag'),
+        last_modified=validators.get('last_modified'),
+    )
+    return store_reference_list(endpoint, entry, data, new_validators)
+
+
+def timed_load_reference_list(session: requests.Session, endpoint: str, refresh: bool = False):
+    started = time.perf_counter()
+    with metrics.span(f'reference.{endpoint}'):
+        data = load_reference_list(session, endpoint, refresh=refresh)
+    elapsed = time.perf_counter() - started
+    logger.info('%s list loaded in %.3fs', endpoint, elapsed)
+    return data
+
+
+def load_reference_index(session: requests.Session, refresh: bool = False,
+                         concurrent: bool = True) -> ReferenceIndex:
+    """
+    Load products, carriers and accounts and build ReferenceIndex.
+
+    With concurrent=True the three lists are loaded in parallel over the shared
+    session connection pool, so the wall time is that of the slowest one.
+    """
+    started = time.perf_counter()
+    if concurrent:
+        with ThreadPoolExecutor(max_workers=len(REFERENCE_ENDPOINTS)) as executor:
+            futures = {
+                endpoint: executor.submit(timed_load_reference_list, session, endpoint, refresh)
+                for endpoint in REFERENCE_ENDPOINTS
+            }
+            lists = {endpoint: future.result() for endpoint, future in futures.items()}
+    else:
+        lists = {
+            endpoint: timed_load_reference_list(session, endpoint, refresh=refresh)
+            for endpoint in REFERENCE_ENDPOINTS
+        }
+    logger.info('reference data loaded in %.3fs', time.perf_counter() - started)
+    return make_reference_index(lists['product'], lists['carrier'], lists['account'])
+
+
+async def load_reference_index_async(client, refresh: bool = False) -> ReferenceIndex:
+    """load products, carriers and accounts concurrently with AsyncAlarisClient"""
+    started = time.perf_counter()
+    products, carriers, accounts = await asyncio.gather(
+        *(load_reference_list_async(client, endpoint, refresh) for endpoint in REFERENCE_ENDPOINTS)
+    )
+    logger.info('reference data loaded in %.3fs', time.perf_counter() - started)
+    return make_reference_index(products, carriers, accounts)
+
+
+def make_reference_index(products, carriers, accounts) -> ReferenceIndex:
+    global last_index, last_index_lists
+    lists = (products, carriers, accounts)
+    # lists are the same objects while they come from memory, no need to index them again
+    if last_index is None or any(new is not old for new, old in zip(lists, last_index_lists)):
+        last_index = ReferenceIndex(*lists)
+        last_index_lists = lists
+    return last_index
+
+
+def fetch_missing(session: requests.Session, retrieve, ids, lru: TTLCache):
+    """fetch objects with ids which are not in lru concurrently and store them in lru"""
+    missing = [obj_id for obj_id in set(ids) if obj_id is not None and obj_id not in lru]
+    if not missing:
+        return
+
+    def fetch(obj_id):
+        try:
+            return obj_id, retrieve(session, str(obj_id))
+        except requests.HTTPError as err:
+            if err.response is not None and err.response.status_code == 404:
+                logger.info('%s: id %s not found', retrieve.__name__, obj_id)
+                return obj_id, None
+            raise
+
+    with ThreadPoolExecutor(max_workers=min(len(missing), REFERENCE_LOOKUP_WORKERS)) as executor:
+        for obj_id, obj in executor.map(fetch, missing):
+            if obj is not None:
+                lru[obj_id] = obj
+
+
+class LazyReferenceIndex(ReferenceIndex):
+    """
+    ReferenceIndex which fetches only referenced products, carriers and accounts.
+
+    prepare() is called with distinct product ids of all matched tasks before their
+    enrichment. Up to threshold ids are retrieved one by one (concurrently) and
+    memoized in LRU caches with REFERENCE_CACHE_TTL, more ids are read from the
+    full lists of load_reference_index without single lookups. Full lists are
+    also used if they are fresh in the local cache or refresh is requested.
+    """
+
+    def __init__(self, session: requests.Session, refresh: bool = False,
+                 threshold: int = REFERENCE_LOOKUP_THRESHOLD):
+        self.session = session
+        self.refresh = refresh
+        self.threshold = threshold
+        self.products = product_lru
+        self.carriers = carrier_lru
+        self.accounts = account_lru
+        self.referenced = set()
+        self.bulk: Optional[ReferenceIndex] = None
+
+    def bulk_is_cached(self) -> bool:
+        return all(
+            cached_reference_list(endpoint, False, REFERENCE_CACHE_TTL)[0] is not None
+            for endpoint in REFERENCE_ENDPOINTS
+        )
+
+    def prepare(self, product_ids) -> ReferenceIndex:
+        """make details of product_ids available and return index to read them from"""
+        if self.bulk is not None:
+            return self.bulk
+        self.referenced.update(product_ids)
+        if self.refresh or len(self.referenced) > self.threshold or self.bulk_is_cached():
+            logger.info('load full reference lists for %s products', len(self.referenced))
+            self.bulk = load_reference_index(self.session, refresh=self.refresh)
+            return self.bulk
+        fetch_missing(self.session, retrieve_product, product_ids, self.products)
+        products = [self.products.get(product_id) for product_id in product_ids]
+        products = [product for product in products if product is not None]
+        fetch_missing(self.session, retrieve_carrier, [p['car_id'] for p in products], self.carriers)
+        fetch_missing(self.session, retrieve_account, [p['acc_id'] for p in products], self.accounts)
+        return self
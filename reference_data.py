@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from logger import create_logger
+
+logger = create_logger(__name__, 'reference_data.log')
+
+
+class ReferenceIndex:
+    """
+    Id-keyed view over Alaris products, carriers and accounts.
+
+    Built once per run so that product -> carrier/account joins are dict lookups
+    instead of scans over the full reference lists.
+    """
+
+    def __init__(self, products: List[Dict], carriers: List[Dict], accounts: List[Dict]):
+        self.products = {product['id']: product for product in products}
+        self.carriers = {carrier['id']: carrier for carrier in carriers}
+        self.accounts = {account['id']: account for account in accounts}
+
+    def __len__(self):
+        return len(self.products)
+
+    def get_product(self, product_id) -> Optional[Dict]:
+        return self.products.get(int(product_id))
+
+    def get_carrier_name(self, car_id) -> Optional[str]:
+        carrier = self.carriers.get(car_id)
+        if carrier is None:
+            logger.info('could not find carrier id %s in alaris data', car_id)
+            return None
+        return carrier['name']
+
+    def get_account_currency(self, acc_id) -> Optional[str]:
+        account = self.accounts.get(acc_id)
+        if account is None:
+            logger.info('could not find account id %s in alaris data', acc_id)
+            return None
+        return account['currency_code']
+
+    def product_details(self, product_id) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+        """
+        Return (carrier name, product description, account currency) for product_id.
+
+        Any part that is missing in alaris data is returned as None.
+        """
+        product = self.get_product(product_id)
+        if product is None:
+            logger.info('could not find product id %s in alaris data', product_id)
+            return None, None, None
+        carrier_name = self.get_carrier_name(product['car_id'])
+        account_currency = self.get_account_currency(product['acc_id'])
+        return carrier_name, product['descr'], account_currency
+
+
+class TTLCache:
+    """
+    Thread safe LRU mapping of at most maxsize items, each item expires ttl seconds
+    after it was set. Has the dict get()/__contains__ used by ReferenceIndex.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if time.monotonic() >= expires_at:
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
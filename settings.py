@@ -0,0 +1,153 @@
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+LOG_LEVEL_NAMES = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+
+def env_str(name: str, default: Optional[str] = None) -> Optional[str]:
+    return os.getenv(name) or default
+
+
+def env_int(name: str, default: int) -> int:
+    return int(os.getenv(name) or default)
+
+
+def env_float(name: str, default: float) -> float:
+    return float(os.getenv(name) or default)
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    Configuration from environment and .env file.
+
+    Loaded once by load_settings() when the settings module is imported,
+    modules keep their constants as aliases of these fields.
+    """
+
+    alaris_domain: Optional[str] = None
+    alaris_user: Optional[str] = None
+    alaris_password: Optional[str] = None
+    alaris_token_ttl: int = 3600
+    alaris_task_update_time_param: Optional[str] = None
+    alaris_async_concurrency: Optional[int] = None
+    # name of the instance from ALARIS_INSTANCES_FILE this process runs for
+    alaris_instance: Optional[str] = None
+    alaris_instances_file: Optional[str] = None
+
+    eapi_url: Optional[str] = None
+    eapi_user: Optional[str] = None
+    eapi_auth: Optional[str] = None
+    eapi_read_timeout: float = 180
+    eapi_window_days: int = 7
+    eapi_mccmnc_chunk_size: int = 100
+    eapi_workers: int = 4
+    eapi_batch_size: int = 1
+
+    http_pool_size: int = 10
+    http_max_retries: int = 3
+    http_backoff_factor: float = 0.5
+    http_connect_timeout: float = 5
+    http_read_timeout: float = 30
+
+    tg_token: Optional[str] = None
+    tg_chat_id: Optional[str] = None
+    tg_api_url: str = 'https://api.telegram.org'
+    tg_messages_per_second: float = 1
+    tg_messages_burst: int = 3
+
+    log_dir: Optional[str] = None
+    log_level: Optional[str] = None
+    log_max_bytes: int = 10 * 1024 * 1024
+    log_backup_count: int = 5
+    cache_dir: Optional[str] = None
+    metrics_file: Optional[str] = None
+
+    reference_cache_ttl: int = 3600
+    reference_lookup_threshold: int = 20
+    reference_lru_size: int = 1024
+
+    rate_update_batch_size: int = 200
+    rate_update_workers: int = 4
+    rate_update_product_workers: int = 4
+    rate_store_file: Optional[str] = None
+    rate_store_ttl: int = 3600
+
+    @property
+    def log_level_is_valid(self) -> bool:
+        return self.log_level in LOG_LEVEL_NAMES
+
+    def cache_path(self, filename: str) -> str:
+        """path of filename in CACHE_DIR, LOG_DIR is used if CACHE_DIR is not set"""
+        return os.path.join(self.cache_dir or self.log_dir or '', filename)
+
+
+def find_env_file() -> Optional[str]:
+    """return .env of the project like dotenv.find_dotenv, looking up from this directory"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        path = os.path.join(directory, '.env')
+        if os.path.isfile(path):
+            return path
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+def load_settings() -> Settings:
+    env_file = find_env_file()
+    if env_file:
+        # dotenv is imported only when there is a file to load
+        from dotenv import load_dotenv
+
+        load_dotenv(env_file)
+    defaults = Settings()
+    return Settings(
+        alaris_domain=env_str('ALARIS_DOMAIN'),
+        alaris_user=env_str('ALARIS_USER'),
+        alaris_password=env_str('PASSWORD'),
+        alaris_token_ttl=env_int('ALARIS_TOKEN_TTL', defaults.alaris_token_ttl),
+        alaris_task_update_time_param=env_str('ALARIS_TASK_UPDATE_TIME_PARAM'),
+        alaris_async_concurrency=int(os.getenv('ALARIS_ASYNC_CONCURRENCY') or 0) or None,
+        alaris_instance=env_str('ALARIS_INSTANCE'),
+        alaris_instances_file=env_str('ALARIS_INSTANCES_FILE'),
+        eapi_url=env_str('ALARIS_EAPI_DOMAIN'),
+        eapi_user=env_str('ALARIS_EAPI_USER'),
+        eapi_auth=env_str('ALARIS_EAPI_AUTH', defaults.eapi_auth),
+        eapi_read_timeout=env_float('ALARIS_EAPI_READ_TIMEOUT', defaults.eapi_read_timeout),
+        eapi_window_days=env_int('ALARIS_EAPI_WINDOW_DAYS', defaults.eapi_window_days),
+        eapi_mccmnc_chunk_size=env_int('ALARIS_EAPI_MCCMNC_CHUNK_SIZE', defaults.eapi_mccmnc_chunk_size),
+        eapi_workers=env_int('ALARIS_EAPI_WORKERS', defaults.eapi_workers),
+        eapi_batch_size=env_int('ALARIS_EAPI_BATCH_SIZE', defaults.eapi_batch_size),
+        http_pool_size=env_int('HTTP_POOL_SIZE', defaults.http_pool_size),
+        http_max_retries=env_int('HTTP_MAX_RETRIES', defaults.http_max_retries),
+        http_backoff_factor=env_float('HTTP_BACKOFF_FACTOR', defaults.http_backoff_factor),
+        http_connect_timeout=env_float('HTTP_CONNECT_TIMEOUT', defaults.http_connect_timeout),
+        http_read_timeout=env_float('HTTP_READ_TIMEOUT', defaults.http_read_timeout),
+        tg_token=env_str('TG_TOKEN'),
+        tg_chat_id=env_str('TG_CHAT_ID'),
+        tg_api_url=env_str('TG_API_URL', defaults.tg_api_url),
+        tg_messages_per_second=env_float('TG_MESSAGES_PER_SECOND', defaults.tg_messages_per_second),
+        tg_messages_burst=env_int('TG_MESSAGES_BURST', defaults.tg_messages_burst),
+        log_dir=env_str('LOG_DIR'),
+        log_level=env_str('LOG_LEVEL'),
+        log_max_bytes=env_int('LOG_MAX_BYTES', defaults.log_max_bytes),
+        log_backup_count=env_int('LOG_BACKUP_COUNT', defaults.log_backup_count),
+        cache_dir=env_str('CACHE_DIR'),
+        metrics_file=env_str('METRICS_FILE'),
+        reference_cache_ttl=env_int('REFERENCE_CACHE_TTL', defaults.reference_cache_ttl),
+        reference_lookup_threshold=env_int('REFERENCE_LOOKUP_THRESHOLD', defaults.reference_lookup_threshold),
+        reference_lru_size=env_int('REFERENCE_LRU_SIZE', defaults.reference_lru_size),
+        rate_update_batch_size=env_int('RATE_UPDATE_BATCH_SIZE', defaults.rate_update_batch_size),
+        rate_update_workers=env_int('RATE_UPDATE_WORKERS', defaults.rate_update_workers),
+        rate_update_product_workers=env_int(
+            'RATE_UPDATE_PRODUCT_WORKERS', defaults.rate_update_product_workers
+        ),
+        rate_store_file=env_str('RATE_STORE_FILE'),
+        rate_store_ttl=env_int('RATE_STORE_TTL', defaults.rate_store_ttl),
+    )
+
+
+settings = load_settings()
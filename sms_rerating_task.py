@@ -1,21 +1,26 @@
-import json
-import os
+import importlib.util
 from datetime import datetime
 from typing import List
 
-from dotenv import load_dotenv
-from requests import HTTPError
+from requests import RequestException
 
-from alaris_api import get_token, get_tasks, get_products, get_accounts, get_carriers, make_session
+from alaris_api import get_token, get_tasks, get_session, iter_tasks
 from logger import create_logger
+from metrics import metrics
+from reference_cache import LazyReferenceIndex, load_reference_index_async
+from reference_data import ReferenceIndex
+from settings import settings
+from task_records import UNDEFINED, ExtendedTask, RerTask
+from task_watermark import TASK_TIME_FORMAT, Watermark
 
-load_dotenv()
 logger = create_logger(__name__, 'sms_rerating_task.log')
 
 
-ALARIS_DOMAIN = os.getenv('ALARIS_DOMAIN')
-ALARIS_USER = os.getenv('ALARIS_USER')
-ALARIS_PASSWD = os.getenv('PASSWORD')
+ALARIS_DOMAIN = settings.alaris_domain
+ALARIS_USER = settings.alaris_user
+ALARIS_PASSWD = settings.alaris_password
+
+TASK_TIME_LENGTH = len('YYYY.MM.DD HH:MM:SS')
 
 TASK_STATUSES = {
     1: 'new',
@@ -29,171 +34,306 @@ TASK_STATUSES = {
 }
 
 
-def check_updated_time(task, time_shift):
-    logger.debug('starting checking update time')
+def time_window(time_shift):
+    """return [start, end) bounds of the time_shift window as task time strings"""
     end_time = datetime.utcnow().replace(second=0, microsecond=0)
     start_time = end_time - time_shift
-    task_last_updated_time = datetime.strptime(
-        task['task_last_update_time'], '%Y.%m.%d %H:%M:%S'
+    return start_time.strftime(TASK_TIME_FORMAT), end_time.strftime(TASK_TIME_FORMAT)
+
+
+def task_update_time(task) -> str:
+    """return task_last_update_time in fixed width 'YYYY.MM.DD HH:MM:SS' format"""
+    task_last_updated_time = task['task_last_update_time']
+    if len(task_last_updated_time) != TASK_TIME_LENGTH:
+        # not zero padded or unexpected time, normalize it before comparing
+        task_last_updated_time = datetime.strptime(
+            task_last_updated_time, TASK_TIME_FORMAT
+        ).strftime(TASK_TIME_FORMAT)
+    return task_last_updated_time
+
+
+def check_updated_time(task, time_shift, window=None):
+    """
+    check that task was updated in the time_shift window.
+
+    Task times have fixed width 'YYYY.MM.DD HH:MM:SS' format, so they are compared
+    with the window bounds as strings. Pass window from time_window() to avoid
+    computing it for every task.
+    """
+    start, end = window or time_window(time_shift)
+    return start <= task_update_time(task) < end
+
+
+def iter_updated_tasks(tasks, time_shift, columnar=False):
+    """
+    yield tasks updated in the time_shift window.
+
+    columnar=True filters a list of tasks with NumPy in one batch (see
+    iter_updated_tasks_columnar), it falls back to string comparison for
+    streams or when NumPy is not installed.
+    """
+    window = time_window(time_shift)
+    if columnar:
+        if isinstance(tasks, list) and numpy_available():
+            yield from iter_updated_tasks_columnar(tasks, window)
+            return
+        logger.warning('columnar filter needs a list of tasks and NumPy, compare times as strings')
+    for task in tasks:
+        if check_updated_time(task, time_shift, window):
+            yield task
+
+
+def numpy_available() -> bool:
+    """check for NumPy without importing it, it is imported only by the columnar filter"""
+    return importlib.util.find_spec('numpy') is not None
+
+
+def iter_updated_tasks_columnar(tasks, window):
+    """
+    iter_updated_tasks for big lists of tasks, update times are compared at once
+    as a NumPy datetime64 column.
+    """
+    import numpy as np
+
+    start, end = (np.datetime64(to_iso(bound)) for bound in window)
+    update_times = np.array(
+        [to_iso(task_update_time(task)) for task in tasks], dtype='datetime64[s]'
     )
-    if start_time <= task_last_updated_time < end_time:
-        logger.debug('finished checking update time')
-        return True
-    logger.debug('finished checking update time')
-    return False
+    matched = np.flatnonzero((update_times >= start) & (update_times < end))
+    logger.debug('columnar filter matched %s of %s tasks', len(matched), len(tasks))
+    for index in matched:
+        yield tasks[index]
 
 
-def get_filtered_task(tasks, time_shift):
-    logger.debug(time_shift)
-    logger.debug('start filtering tasks')
-    logger.debug(f'count of tasks for filtering {len(tasks)}')
-    filtered_task = []
+def to_iso(task_time: str) -> str:
+    """convert 'YYYY.MM.DD HH:MM:SS' into ISO 8601 'YYYY-MM-DDTHH:MM:SS'"""
+    return task_time.replace('.', '-', 2).replace(' ', 'T', 1)
+
+
+def iter_finished_tasks(tasks):
     for task in tasks:
-        logger.debug(f'task: {task}')
         in_progress = task.get('task_result', 'finished')
-        if check_updated_time(task, time_shift) and 'in progress:' not in in_progress:
-            task_param_json = json.loads(task['task_param_json'])
-            try:
-                is_autorerating = task_param_json['autorerating']
-            except KeyError:
-                # ToDo undefined task. need special handler
-                continue
-            if is_autorerating != '1':
-                task.update({'task_param_json': task_param_json})
-                filtered_task.append(task)
+        if 'in progress:' not in in_progress:
+            yield task
+
+
+def iter_manual_tasks(tasks):
+    """decode tasks into RerTask records and yield ones that were not created by autorerating"""
+    for task in tasks:
+        record = RerTask.from_dict(task)
+        # ToDo task without autorerating flag is undefined and needs special handler
+        if record.is_manual:
+            yield record
+
+
+def get_filtered_task(tasks, time_shift, columnar=False):
+    """
+    yield manual rerating tasks updated in the time_shift window.
+
+    tasks could be any iterable, e.g. a stream from alaris_api.iter_tasks,
+    task_param_json is decoded only for tasks that passed the time check.
+    """
+    logger.debug(time_shift)
+    logger.debug('start filtering tasks')
+    yield from iter_manual_tasks(
+        iter_finished_tasks(iter_updated_tasks(tasks, time_shift, columnar=columnar))
+    )
+    logger.info('finished filtering task')
+
+
+def get_incremental_task(tasks, watermark: Watermark, end_time):
+    """
+    yield manual rerating tasks updated after watermark and before end_time.
+
+    Tasks in progress do not move the watermark.
+    """
+    logger.debug('start filtering tasks by watermark')
+    finished_tasks = iter_finished_tasks(watermark.iter_unseen_tasks(tasks, end_time))
+    yield from iter_manual_tasks(watermark.iter_advancing(finished_tasks))
     logger.info('finished filtering task')
-    return filtered_task
 
 
-def get_products_caption(product_ids, products, carriers, accounts):
+def get_products_caption(product_ids, reference: ReferenceIndex):
     if product_ids == '':
         products_caption = 'All products'
     elif product_ids == '0':
         products_caption = 'include undefined products'
     else:
-        products_caption = get_product_caption(
-            product_ids,
-            products=products,
-            carriers=carriers,
-            accounts=accounts
-        )
+        products_caption = get_product_caption(product_ids, reference)
     return products_caption
 
 
-def get_product_caption(product_ids, products, carriers, accounts) -> List[str]:
-    logger.info(f'collect product caption for ids {product_ids}')
+def get_product_caption(product_ids, reference: ReferenceIndex) -> List[str]:
+    logger.info('collect product caption for ids %s', product_ids)
     products_description = []
     for product_id in product_ids.split(','):
-        logger.debug(f'collect info about product_id: {product_id}')
-        if product_id == 0:
+        logger.debug('collect info about product_id: %s', product_id)
+        product_id = product_id.strip()
+        if product_id == '0':
             products_description.append('include undefined product')
+        elif not product_id.isdigit():
+            logger.info('unexpected product id %r', product_id)
+            products_description.append(f'undefined product {product_id}')
         else:
             carrier_name, product_descr, currency_code = collect_product_details(
-                int(product_id),
-                products=products,
-                carriers=carriers,
-                accounts=accounts
+                int(product_id), reference
             )
             products_description.append(f'{carrier_name} - {product_descr}({currency_code})')
-    logger.debug(f'products description list: {products_description}')
+    logger.debug('products description list: %s', products_description)
     return products_description
 
 
-def collect_product_details(product_id, products, carriers, accounts):
-    logger.debug(f'collect product details for product_id {product_id}')
-    for sms_product in products:
-        if sms_product['id'] == product_id:
-            product = sms_product
-            break
-    else:
-        logger.info(f'could not find product id {product_id} in alaris data')
-        return None, None, None
-    product_descr = product['descr']
-    car_id = product['car_id']
-    acc_id = product['acc_id']
-    carrier = list(filter(lambda x: x['id'] == car_id, carriers))[0]
-    carrier_name = carrier['name']
-    account = list(filter(lambda x: x['id'] == acc_id, accounts))[0]
-    account_currency = account['currency_code']
+def collect_product_details(product_id, reference: ReferenceIndex):
+    logger.debug('collect product details for product_id %s', product_id)
+    carrier_name, product_descr, account_currency = reference.product_details(product_id)
     logger.debug(account_currency)
     logger.debug(carrier_name)
     logger.debug(product_descr)
     return carrier_name, product_descr, account_currency
 
 
-def extend_task_data(task, products, carriers, accounts):
-    task_param_json: dict = task['task_param_json']
-    try:
-        task_status = TASK_STATUSES[task['task_status']]
-    except KeyError:
-        task_status = 'undefined'
-    try:
-        dst_product_ids = task_param_json['dst_product_ids']
-    except KeyError:
-        dst_product_ids = 'undefined'
-    try:
-        src_product_ids = task_param_json['src_product_ids']
-    except KeyError:
-        src_product_ids = 'undefined'
-    try:
-        rerating_start_time = task_param_json['start_date']
-    except KeyError:
-        rerating_start_time = 'undefined'
-    try:
-        rerating_end_time = task_param_json['end_date']
-    except KeyError:
-        rerating_end_time = 'undefined'
-
-    dst_product_ids = get_products_caption(dst_product_ids, products=products, carriers=carriers, accounts=accounts)
-    src_product_ids = get_products_caption(src_product_ids, products=products, carriers=carriers, accounts=accounts)
-
-    task_start_time = task_param_json['task_start_time']
-    if task_start_time == '':
-        task_start_time = task['task_start_time']
-    task_last_update_time = task['task_last_update_time']
-    extended_task = {
-        'task_id': task['id'],
-        'task_status': task_status,
-        'task_start_time': task_start_time,
-        'task_last_uprate_time': task_last_update_time,
-        'src_product_ids': src_product_ids,
-        'dst_product_ids': dst_product_ids,
-        'rerating_start_time': rerating_start_time,
-        'rerating_end_time': rerating_end_time,
-    }
-    return extended_task
-
-
-def main(time_shift):
+def task_product_ids(task: RerTask) -> List[int]:
+    """return ids of products referenced by src/dst product lists of the task"""
+    product_ids = []
+    for products in (task.src_product_ids, task.dst_product_ids):
+        for product_id in products.split(','):
+            product_id = product_id.strip()
+            if product_id.isdigit() and product_id != '0':
+                product_ids.append(int(product_id))
+    return product_ids
+
+
+def products_caption_value(product_ids: str, reference: ReferenceIndex):
+    caption = get_products_caption(product_ids, reference)
+    return tuple(caption) if isinstance(caption, list) else caption
+
+
+def extend_task_data(task: RerTask, reference: ReferenceIndex) -> ExtendedTask:
+    return ExtendedTask(
+        task_id=task.id,
+        task_status=TASK_STATUSES.get(task.status, UNDEFINED),
+        task_start_time=task.param_start_time or task.start_time,
+        task_last_uprate_time=task.last_update_time,
+        src_product_ids=products_caption_value(task.src_product_ids, reference),
+        dst_product_ids=products_caption_value(task.dst_product_ids, reference),
+        rerating_start_time=task.rerating_start_time,
+        rerating_end_time=task.rerating_end_time,
+    )
+
+
+def prepare_polling(time_shift, incremental):
+    """return (watermark, window end time, /task query params) for the poll"""
+    if not incremental:
+        return None, None, {}
+    end_time = datetime.utcnow().replace(second=0, microsecond=0)
+    watermark = Watermark.load()
+    watermark.start_from(end_time - time_shift)
+    return watermark, end_time, watermark.query_params()
+
+
+def filter_tasks(tasks, time_shift, watermark=None, end_time=None, columnar=False):
+    """filter tasks by watermark in incremental mode, otherwise by time_shift window"""
+    if watermark is not None:
+        return get_incremental_task(tasks, watermark, end_time)
+    return get_filtered_task(tasks, time_shift, columnar=columnar)
+
+
+def finish_polling(watermark, found):
+    if not found:
+        logger.info('did not find new tasks in the specified time delta')
+    if watermark is not None:
+        watermark.save()
+        logger.info('watermark moved to %s', watermark.last_update_time)
+
+
+def main(time_shift, refresh_cache=False, stream=True, incremental=False, columnar=False):
+    """
+    yield extended manual rerating tasks updated in the last time_shift.
+
+    With incremental=True tasks are fetched starting from the watermark stored by
+    the previous run (time_shift is used for the first run only), so ticks skipped
+    by cron are not lost. columnar=True downloads the whole task list and filters
+    it by time with NumPy, see iter_updated_tasks_columnar.
+    """
     logger.info('start work')
-    logger.info(f'time_shift={time_shift}')
+    logger.info('time_shift=%s', time_shift)
     try:
-        token = get_token()
-    except HTTPError as err:
-        logger.exception(f'an HTTP error occurred\n{err}')
+        with metrics.span('get_token'):
+            get_token()
+    except RequestException as err:
+        logger.exception('an HTTP error occurred\n%s', err)
         logger.warning('could not retrieve data')
         return
-    http_session = make_session(token)
+    session = get_session()
+    session.reset_latencies()
+    watermark, end_time, params = prepare_polling(time_shift, incremental)
+    reference = LazyReferenceIndex(session, refresh=refresh_cache)
+    found = False
     try:
-        with http_session as session:
-            tasks = get_tasks(session, task_type_id=11)
-    except HTTPError as err:
-        logger.exception(f'an HTTP error\n {err}', stack_info=True)
+        if stream and not columnar:
+            tasks = metrics.timed_iter(
+                'tasks.fetch', iter_tasks(session, task_type_id=11, **params), counter='tasks_scanned'
+            )
+        else:
+            # the columnar filter needs the whole list
+            with metrics.span('tasks.fetch'):
+                tasks = get_tasks(session, task_type_id=11, **params)
+            metrics.incr('tasks_scanned', len(tasks))
+        filtered_tasks = metrics.timed_iter(
+            'tasks.filter',
+            filter_tasks(tasks, time_shift, watermark, end_time, columnar=columnar),
+            counter='tasks_matched',
+        )
+        # matched tasks are few, collect them to choose single or bulk reference lookups once
+        matched_tasks = list(filtered_tasks)
+        if matched_tasks:
+            product_ids = {product_id for task in matched_tasks for product_id in task_product_ids(task)}
+            with metrics.span('reference.prepare'):
+                index = reference.prepare(product_ids)
+        for task in matched_tasks:
+            found = True
+            logger.info('task for handling %s', task)
+            with metrics.span('tasks.enrich'):
+                extended_task = extend_task_data(task, index)
+            yield extended_task
+    except RequestException as err:
+        logger.exception('an HTTP error\n %s', err, stack_info=True)
         return
-    filtered_task = get_filtered_task(tasks, time_shift)
-    if filtered_task:
-        with http_session as session:
-            products = get_products(session)
-            carriers = get_carriers(session)
-            accounts = get_accounts(session)
-    else:
-        logger.info('did not find new tasks in the specified time delta')
-    for task in filtered_task:
-        logger.info(f'task for handling {task}')
-        task = extend_task_data(task, products=products, carriers=carriers, accounts=accounts)
-        yield task
+    finish_polling(watermark, found)
+    logger.info('alaris api latency: %s', session.latency_summary())
     logger.info('finished work')
 
 
+async def main_async(time_shift, refresh_cache=False, incremental=False,
+                     columnar=False) -> List[ExtendedTask]:
+    """main() on alaris_api_async.AsyncAlarisClient, returns list of extended tasks"""
+    from alaris_api_async import AsyncAlarisClient, httpx
+
+    logger.info('start async work')
+    logger.info('time_shift=%s', time_shift)
+    watermark, end_time, params = prepare_polling(time_shift, incremental)
+    async with AsyncAlarisClient() as client:
+        try:
+            with metrics.span('tasks.fetch'):
+                tasks = await client.get_tasks(task_type_id=11, **params)
+            metrics.incr('tasks_scanned', len(tasks))
+            with metrics.span('tasks.filter'):
+                filtered_task = list(
+                    filter_tasks(tasks, time_shift, watermark, end_time, columnar=columnar)
+                )
+            metrics.incr('tasks_matched', len(filtered_task))
+            if filtered_task:
+                with metrics.span('reference.load'):
+                    reference = await load_reference_index_async(client, refresh=refresh_cache)
+        except httpx.HTTPError as err:
+            logger.exception('an HTTP error\n %s', err, stack_info=True)
+            return []
+    with metrics.span('tasks.enrich'):
+        extended_tasks = [extend_task_data(task, reference) for task in filtered_task]
+    finish_polling(watermark, bool(filtered_task))
+    logger.info('finished async work')
+    return extended_tasks
+
+
 if __name__ == '__main__':
     main(time_shift=6500)
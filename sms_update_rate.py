@@ -1,14 +1,34 @@
-import requests
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Optional
 
-from requests import HTTPError
+from requests import RequestException
 
 import alaris_api
 import alaris_enterprise_api as eapi
 from logger import create_logger
-
+from metrics import metrics
+from rate_store import (
+    RATE_END_DATE_KEYS,
+    RATE_START_DATE_KEYS,
+    RAW_RATE_PRODUCT_KEY,
+    invalidate_products,
+    rate_date,
+    stored_raw_rates,
+)
+from settings import settings
 
 logger = create_logger(__name__, "sms_update_rate.log")
 
+RATE_UPDATE_BATCH_SIZE = settings.rate_update_batch_size
+RATE_UPDATE_WORKERS = settings.rate_update_workers
+RATE_UPDATE_PRODUCT_WORKERS = settings.rate_update_product_workers
+DEFAULT_PRODUCTS = ["14023"]
+
 
 def collect_rate_list_for_update(mccmnc_for_update, rate_start_date, rate_end_date):
     rates = [
@@ -23,40 +43,456 @@ def collect_rate_list_for_update(mccmnc_for_update, rate_start_date, rate_end_da
     return rates
 
 
-def update_sms_rate(rate_start_date, rate_end_date, **kwargs):
-    logger.info(f"rate_start_date: {rate_start_date}")
-    logger.info(f"rate_end_date: {rate_end_date}")
-    logger.info(f"additional args {kwargs}")
+def rate_key(rate: Dict):
+    return (
+        str(rate["mccmnc"]),
+        rate_date(rate, RATE_START_DATE_KEYS),
+        rate_date(rate, RATE_END_DATE_KEYS),
+    )
+
+
+def diff_rates(current_rates: List[Dict], target_rates: List[Dict]) -> List[Dict]:
+    """
+    return target rates which differ from current raw EAPI rates.
+
+    Rates are keyed by (mccmnc, start date, end date). A target row is skipped only
+    if every current row of its mccmnc has the same key and the same rate, so an
+    mccmnc with any other rate inside the period is still updated.
+    """
+    current = {}
+    for rate in current_rates:
+        current.setdefault(str(rate["mccmnc"]), set()).add(
+            (rate_key(rate), float(rate.get("rate") or 0))
+        )
+    return [
+        rate for rate in target_rates
+        if current.get(str(rate["mccmnc"])) != {(rate_key(rate), float(rate["rate"]))}
+    ]
+
+
+def emit_rates(rate_sink, product_id, rates: List[Dict], status: str, error: str = None):
+    """pass every rate row of product to rate_sink, e.g. record_writer.RecordWriter.write"""
+    if rate_sink is None:
+        return
+    for rate in rates:
+        rate_sink({"product_id": str(product_id), **rate, "status": status, "error": error})
+
+
+def chunked(items: List, size: int) -> Iterable[List]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def merge_mini_reports(reports: Iterable) -> Dict:
+    """sum numeric values of chunk mini reports, other values are collected into lists"""
+    merged = {}
+    for report in reports:
+        if not isinstance(report, dict):
+            merged.setdefault("details", []).append(report)
+            continue
+        for key, value in report.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[key] = merged.get(key, 0) + value
+            elif isinstance(value, list):
+                merged.setdefault(key, []).extend(value)
+            else:
+                merged.setdefault(key, []).append(value)
+    return merged
+
+
+class UpdateProgress:
+    """
+    MCCMNCs already updated by a chunked rate update.
+
+    Progress is stored in CACHE_DIR per product and rate period, so a failed run
+    could be started again and continue from the chunks that were not committed.
+    """
+
+    def __init__(self, product_id, rate_start_date, rate_end_date):
+        key = f"{product_id}:{rate_start_date}:{rate_end_date}"
+        digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+        self.path = settings.cache_path(f"rate_update_progress_{digest}.json")
+        self.lock = threading.Lock()
+        self.committed = set()
+        self.reports = []
+        try:
+            with open(self.path) as progress_file:
+                data = json.load(progress_file)
+            self.committed = set(data["committed"])
+            self.reports = data["reports"]
+            logger.info("resume rate update, %s mccmnc already updated", len(self.committed))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as err:
+            logger.warning("could not read rate update progress %s: %s", self.path, err)
+
+    def commit(self, rates: List[Dict], mini_report):
+        with self.lock:
+            self.committed.update(rate["mccmnc"] for rate in rates)
+            self.reports.append(mini_report)
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, "w") as progress_file:
+                    json.dump(
+                        {"committed": sorted(self.committed), "reports": self.reports}, progress_file
+                    )
+                os.replace(tmp_path, self.path)
+            except OSError as err:
+                # the chunk is uploaded already, a rerun would only upload it again
+                logger.warning("could not save rate update progress %s: %s", self.path, err)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def update_rates_in_chunks(session, product_id, new_rates: List[Dict], rate_start_date,
+                           rate_end_date, batch_size: int = RATE_UPDATE_BATCH_SIZE,
+                           workers: int = RATE_UPDATE_WORKERS, rate_sink=None) -> Dict:
+    """
+    Upload new_rates in chunks of batch_size rows with at most workers requests at once.
+
+    Chunks that were committed by a previous failed run are skipped. If any chunk fails
+    the others are finished, progress is saved and the first error is raised.
+    Rows of every chunk are passed to rate_sink as 'updated' or 'failed' when it is done.
+    """
+    progress = UpdateProgress(product_id, rate_start_date, rate_end_date)
+    pending = [rate for rate in new_rates if rate["mccmnc"] not in progress.committed]
+    chunks = list(chunked(pending, batch_size))
+    logger.info("update %s rates of product %s in %s chunks", len(pending), product_id, len(chunks))
+    errors = []
+
+    def upload(chunk):
+        try:
+            report = alaris_api.update_sms_rate(session, product_id=product_id, new_rates=chunk)
+        except RequestException as err:
+            emit_rates(rate_sink, product_id, chunk, "failed", str(err))
+            raise
+        progress.commit(chunk, report["mini_report"])
+        metrics.incr("rates_uploaded", len(chunk))
+        emit_rates(rate_sink, product_id, chunk, "updated")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(upload, chunk) for chunk in chunks]
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except RequestException as err:
+                logger.exception("could not update rates chunk\n%s", err)
+                errors.append(err)
+    if errors:
+        raise errors[0]
+    progress.clear()
+    return {
+        "mini_report": merge_mini_reports(progress.reports),
+        "chunks": len(progress.reports),
+        "rates": len(progress.committed),
+    }
+
+
+def group_rates_by_product(current_rates: Iterable[Dict],
+                           products: List[str]) -> Optional[Dict[str, List[Dict]]]:
+    """
+    split raw EAPI rates of several products into per product lists.
+    Returns None if rows do not have RAW_RATE_PRODUCT_KEY, then rates should be
+    requested per product.
+    """
+    if len(products) == 1:
+        return {products[0]: list(current_rates)}
+    grouped = {product: [] for product in products}
+    for rate in current_rates:
+        product_id = rate.get(RAW_RATE_PRODUCT_KEY)
+        if product_id is None:
+            logger.warning("raw rates have no %s key, request them per product", RAW_RATE_PRODUCT_KEY)
+            return None
+        grouped.setdefault(str(product_id), []).append(rate)
+    return grouped
+
+
+def plan_product_rates(product_id, current_rates, rate_start_date, rate_end_date):
+    """return (zero rates for every mccmnc of product, rates which differ from current ones)"""
+    logger.info("rate count for update of product %s: %s", product_id, len(current_rates))
+    logger.debug("raw rates: %s", current_rates)
+    mccmncs = sorted(set(rate["mccmnc"] for rate in current_rates))
+    new_rates = collect_rate_list_for_update(
+        mccmncs, rate_start_date, rate_end_date
+    )
+    changed_rates = diff_rates(current_rates, new_rates)
+    metrics.incr("rates_changed", len(changed_rates))
+    logger.info(
+        "product %s: %s of %s rates will be changed", product_id, len(changed_rates), len(new_rates)
+    )
+    logger.debug(changed_rates)
+    return new_rates, changed_rates
+
+
+def update_product_rates(session, product_id, current_rates, rate_start_date, rate_end_date, **kwargs):
+    new_rates, changed_rates = plan_product_rates(
+        product_id, current_rates, rate_start_date, rate_end_date
+    )
+    if kwargs.get("dry_run"):
+        emit_rates(kwargs.get("rate_sink"), product_id, changed_rates, "planned")
+        return dry_run_report(new_rates, changed_rates)
+    if not changed_rates:
+        return {"mini_report": {}, "chunks": 0, "rates": 0}
+    update_report = update_rates_in_chunks(
+        session,
+        product_id=int(product_id),
+        new_rates=changed_rates,
+        rate_start_date=rate_start_date,
+        rate_end_date=rate_end_date,
+        batch_size=kwargs.get("batch_size") or RATE_UPDATE_BATCH_SIZE,
+        workers=kwargs.get("workers") or RATE_UPDATE_WORKERS,
+        rate_sink=kwargs.get("rate_sink"),
+    )
+    logger.info("product %s: %s", product_id, update_report['mini_report'])
+    return update_report
+
+
+def dry_run_report(new_rates, changed_rates) -> Dict:
+    return {
+        "mini_report": {},
+        "unchanged": len(new_rates) - len(changed_rates),
+        "changes": changed_rates,
+    }
+
+
+def consolidate_reports(product_reports: Dict[str, Dict]) -> Dict:
+    return {
+        "mini_report": merge_mini_reports(
+            report["mini_report"] for report in product_reports.values() if "mini_report" in report
+        ),
+        "products": product_reports,
+    }
+
+
+def report_summary(update_report: Optional[Dict]) -> str:
+    """short text of update_sms_rate report for notifications: totals and a line per product"""
+    if update_report is None:
+        return "failed, see sms_update_rate.log"
+    totals = {
+        key: value for key, value in update_report["mini_report"].items()
+        if isinstance(value, (int, float))
+    }
+    lines = [f"total: {totals}"] if totals else []
+    for product_id, report in sorted(update_report["products"].items()):
+        if "error" in report:
+            lines.append(f"{product_id}: error {report['error'][:200]}")
+        elif "changes" in report:
+            lines.append(f"{product_id}: {len(report['changes'])} rates planned")
+        else:
+            lines.append(f"{product_id}: {report['rates']} rates in {report['chunks']} chunks")
+    return "\n".join(lines)
+
+
+def update_sms_rate(rate_start_date, rate_end_date, products=None, **kwargs):
+    """
+    Set to zero rates of products between rate_start_date and rate_end_date.
+
+    Raw rates of all products are fetched with one EAPI call, or with
+    from_store=True read from the local rate_store.RateStore, then products are
+    updated in parallel on a pool of RATE_UPDATE_PRODUCT_WORKERS threads.
+    Returns consolidated report with per product reports and merged mini_report,
+    with rate_sink every planned, updated or failed rate row is passed to it.
+    """
+    products = [str(product) for product in products or DEFAULT_PRODUCTS]
+    logger.info("rate_start_date: %s", rate_start_date)
+    logger.info("rate_end_date: %s", rate_end_date)
+    logger.info("products: %s", products)
+    logger.info("additional args %s", kwargs)
     codes = kwargs.get("codes", [])
     mccmnc = '' if not codes else ','.join(codes)
 
     try:
-        token = alaris_api.get_token()
-    except HTTPError as err:
-        logger.exception(f"an HTTP error occurred\n{err}")
+        with metrics.span("get_token"):
+            alaris_api.get_token()
+    except RequestException as err:
+        logger.exception("an HTTP error occurred\n%s", err)
         return
+
+    def fetch_rates(product_ids: List[str]):
+        if kwargs.get("from_store"):
+            current_rates = stored_raw_rates(product_ids, rate_start_date, rate_end_date, mccmnc)
+        else:
+            current_rates = eapi.iter_raw_sms_rates(
+                product=",".join(product_ids),
+                start_date=rate_start_date,
+                end_date=rate_end_date,
+                mccmnc_list=mccmnc,
+            )
+        return metrics.timed_iter("rates.fetch", current_rates, counter="rates_scanned")
+
     try:
-        session = alaris_api.make_session(token=token)
-        current_rates = eapi.get_raw_sms_rates(
-            product="14023",
-            start_date=rate_start_date,
-            end_date=rate_end_date,
-            mccmnc_list=mccmnc,
-        )
-        logger.debug(f"rate count for update {len(current_rates)}")
-        logger.debug(f"raw rates: {current_rates}")
-        mccmncs = set(rate["mccmnc"] for rate in current_rates)
-        new_rates = collect_rate_list_for_update(
-            mccmncs, rate_start_date, rate_end_date
-        )
-        logger.debug(new_rates)
-        update_report = alaris_api.update_sms_rate(
-            session, product_id=14023, new_rates=new_rates
-        )
-        logger.info(update_report["mini_report"])
-        return update_report
-    except requests.HTTPError as err:
-        logger.exception(f"an http error\n{err}", stack_info=True)
+        session = alaris_api.get_session()
+        rates_by_product = group_rates_by_product(fetch_rates(products), products)
+        if rates_by_product is None:
+            rates_by_product = {product: list(fetch_rates([product])) for product in products}
+    except RequestException as err:
+        logger.exception("an http error\n%s", err, stack_info=True)
+        return
+    product_reports = {}
+    with metrics.span("rates.update"):
+        with ThreadPoolExecutor(max_workers=RATE_UPDATE_PRODUCT_WORKERS) as executor:
+            futures = {
+                executor.submit(
+                    update_product_rates,
+                    session,
+                    product_id,
+                    product_rates,
+                    rate_start_date,
+                    rate_end_date,
+                    **kwargs,
+                ): product_id
+                for product_id, product_rates in rates_by_product.items()
+            }
+            for future in as_completed(futures):
+                product_id = futures[future]
+                try:
+                    product_reports[product_id] = future.result()
+                except RequestException as err:
+                    logger.exception("an http error during update of product %s\n%s", product_id, err)
+                    product_reports[product_id] = {"error": str(err)}
+    if not kwargs.get("dry_run"):
+        invalidate_products(products)
+    update_report = consolidate_reports(product_reports)
+    logger.info(update_report["mini_report"])
+    logger.info("alaris api latency: %s", session.latency_summary())
+    logger.info("EAPI latency: %s", eapi.eapi_client.session.latency_summary())
+    return update_report
+
+
+async def update_rates_in_chunks_async(client, product_id, new_rates: List[Dict], rate_start_date,
+                                 rate_end_date, batch_size: int = RATE_UPDATE_BATCH_SIZE,
+                                 rate_sink=None) -> Dict:
+    """update_rates_in_chunks on AsyncAlarisClient, concurrency is limited by the client"""
+    progress = UpdateProgress(product_id, rate_start_date, rate_end_date)
+    pending = [rate for rate in new_rates if rate["mccmnc"] not in progress.committed]
+    chunks = list(chunked(pending, batch_size))
+    logger.info("update %s rates of product %s in %s chunks", len(pending), product_id, len(chunks))
+
+    async def upload(chunk):
+        try:
+            report = await client.update_sms_rate(product_id=product_id, new_rates=chunk)
+        except Exception as err:
+            emit_rates(rate_sink, product_id, chunk, "failed", str(err))
+            raise
+        progress.commit(chunk, report["mini_report"])
+        metrics.incr("rates_uploaded", len(chunk))
+        emit_rates(rate_sink, product_id, chunk, "updated")
+
+    results = await asyncio.gather(*(upload(chunk) for chunk in chunks), return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    for err in errors:
+        logger.error("could not update rates chunk\n%r", err)
+    if errors:
+        raise errors[0]
+    progress.clear()
+    return {
+        "mini_report": merge_mini_reports(progress.reports),
+        "chunks": len(progress.reports),
+        "rates": len(progress.committed),
+    }
+
+
+async def update_product_rates_async(client, product_id, current_rates, rate_start_date,
+                                     rate_end_date, **kwargs):
+    new_rates, changed_rates = plan_product_rates(
+        product_id, current_rates, rate_start_date, rate_end_date
+    )
+    if kwargs.get("dry_run"):
+        emit_rates(kwargs.get("rate_sink"), product_id, changed_rates, "planned")
+        return dry_run_report(new_rates, changed_rates)
+    if not changed_rates:
+        return {"mini_report": {}, "chunks": 0, "rates": 0}
+    update_report = await update_rates_in_chunks_async(
+        client,
+        product_id=int(product_id),
+        new_rates=changed_rates,
+        rate_start_date=rate_start_date,
+        rate_end_date=rate_end_date,
+        batch_size=kwargs.get("batch_size") or RATE_UPDATE_BATCH_SIZE,
+        rate_sink=kwargs.get("rate_sink"),
+    )
+    logger.info("product %s: %s", product_id, update_report['mini_report'])
+    return update_report
+
+
+async def update_sms_rate_async(rate_start_date, rate_end_date, products=None, **kwargs):
+    """
+    update_sms_rate on alaris_api_async.AsyncAlarisClient.
+
+    EAPI windows, products and rate chunks are all requested concurrently,
+    the number of requests in flight is limited by the client.
+    """
+    from alaris_api_async import AsyncAlarisClient, httpx
+
+    products = [str(product) for product in products or DEFAULT_PRODUCTS]
+    logger.info("async update of products %s from %s till %s", products, rate_start_date, rate_end_date)
+    codes = kwargs.get("codes", [])
+    mccmnc = '' if not codes else ','.join(codes)
+
+    async def fetch_rates(product_ids: List[str]):
+        with metrics.span("rates.fetch"):
+            if kwargs.get("from_store"):
+                rate_lists = [stored_raw_rates(product_ids, rate_start_date, rate_end_date, mccmnc)]
+            else:
+                rate_lists = await asyncio.gather(
+                    *(
+                        client.get_raw_sms_rates(",".join(product_ids), window_start, window_end, codes)
+                        for window_start, window_end, codes in eapi.rate_windows(
+                            rate_start_date, rate_end_date, mccmnc
+                        )
+                    )
+                )
+        return metrics.timed_iter("rates.dedupe", eapi.unique_rates(rate_lists), counter="rates_scanned")
+
+    async with AsyncAlarisClient() as client:
+        try:
+            rates_by_product = group_rates_by_product(await fetch_rates(products), products)
+            if rates_by_product is None:
+                product_rates = await asyncio.gather(*(fetch_rates([product]) for product in products))
+                rates_by_product = {
+                    product: list(rates) for product, rates in zip(products, product_rates)
+                }
+        except httpx.HTTPError as err:
+            logger.exception("an http error\n%s", err, stack_info=True)
+            return
+        with metrics.span("rates.update"):
+            results = await asyncio.gather(
+                *(
+                    update_product_rates_async(
+                        client, product_id, product_rates, rate_start_date, rate_end_date, **kwargs
+                    )
+                    for product_id, product_rates in rates_by_product.items()
+                ),
+                return_exceptions=True,
+            )
+    if not kwargs.get("dry_run"):
+        invalidate_products(products)
+    product_reports = {}
+    for product_id, result in zip(rates_by_product, results):
+        if isinstance(result, httpx.HTTPError):
+            logger.error("an http error during update of product %s\n%r", product_id, result)
+            result = {"error": str(result)}
+        elif isinstance(result, Exception):
+            raise result
+        product_reports[product_id] = result
+    update_report = consolidate_reports(product_reports)
+    logger.info(update_report["mini_report"])
+    return update_report
+
+
+def read_products_file(path: str) -> List[str]:
+    """read product ids separated by new lines and/or commas"""
+    with open(path) as products_file:
+        return [
+            product.strip()
+            for line in products_file
+            for product in line.split(",")
+            if product.strip()
+        ]
 
 
 if __name__ == "__main__":
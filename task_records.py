@@ -0,0 +1,82 @@
+import json
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple, Union
+
+UNDEFINED = 'undefined'
+
+ProductsCaption = Union[str, Tuple[str, ...]]
+
+
+@dataclass(frozen=True)
+class RerTask:
+    """
+    Rerating task from alaris /task with decoded task_param_json.
+
+    Made by from_dict() once the task passed the time and state filters, values
+    missing in task_param_json are 'undefined', autorerating is None if absent.
+    """
+
+    __slots__ = (
+        'id', 'status', 'start_time', 'last_update_time', 'autorerating',
+        'src_product_ids', 'dst_product_ids', 'rerating_start_time',
+        'rerating_end_time', 'param_start_time',
+    )
+
+    id: int
+    status: int
+    start_time: str
+    last_update_time: str
+    autorerating: Optional[str]
+    src_product_ids: str
+    dst_product_ids: str
+    rerating_start_time: str
+    rerating_end_time: str
+    param_start_time: str
+
+    @classmethod
+    def from_dict(cls, task: Dict) -> 'RerTask':
+        params = task['task_param_json']
+        if isinstance(params, str):
+            params = json.loads(params)
+        return cls(
+            id=task['id'],
+            status=task.get('task_status'),
+            start_time=task.get('task_start_time', ''),
+            last_update_time=task['task_last_update_time'],
+            autorerating=params.get('autorerating'),
+            src_product_ids=str(params.get('src_product_ids', UNDEFINED)),
+            dst_product_ids=str(params.get('dst_product_ids', UNDEFINED)),
+            rerating_start_time=params.get('start_date', UNDEFINED),
+            rerating_end_time=params.get('end_date', UNDEFINED),
+            param_start_time=params.get('task_start_time', ''),
+        )
+
+    @property
+    def is_manual(self) -> bool:
+        return self.autorerating is not None and self.autorerating != '1'
+
+
+@dataclass(frozen=True)
+class ExtendedTask:
+    """rerating task with product captions, what is printed and sent to telegram"""
+
+    __slots__ = (
+        'task_id', 'task_status', 'task_start_time', 'task_last_uprate_time',
+        'src_product_ids', 'dst_product_ids', 'rerating_start_time', 'rerating_end_time',
+    )
+
+    task_id: int
+    task_status: str
+    task_start_time: str
+    task_last_uprate_time: str
+    src_product_ids: ProductsCaption
+    dst_product_ids: ProductsCaption
+    rerating_start_time: str
+    rerating_end_time: str
+
+    def as_dict(self) -> Dict:
+        """return the task as dict, product captions as lists"""
+        return {
+            name: list(value) if isinstance(value, tuple) else value
+            for name, value in ((name, getattr(self, name)) for name in self.__slots__)
+        }
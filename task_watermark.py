@@ -0,0 +1,109 @@
+import json
+import os
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, Optional, Set
+
+
+from logger import create_logger
+from settings import settings
+
+logger = create_logger(__name__, 'task_watermark.log')
+
+WATERMARK_FILE = settings.cache_path('rerating_task_watermark.json')
+# name of alaris /task query parameter with lower bound of task_last_update_time.
+# Leave empty if alaris does not support it, the bound is checked locally anyway
+TASK_UPDATE_TIME_PARAM = settings.alaris_task_update_time_param
+
+TASK_TIME_FORMAT = '%Y.%m.%d %H:%M:%S'
+
+
+class Watermark:
+    """
+    High-water mark of handled rerating tasks.
+
+    Keeps the latest seen task_last_update_time and ids of tasks updated at that
+    time, so the next run fetches tasks starting from that time and skips tasks
+    already seen at the boundary. Task times are fixed width strings, so they are
+    compared as strings.
+    """
+
+    def __init__(self, last_update_time: Optional[str] = None, task_ids: Iterable = ()):
+        self.last_update_time = last_update_time
+        self.task_ids: Set = set(task_ids)
+
+    @classmethod
+    def load(cls, path: str = WATERMARK_FILE) -> 'Watermark':
+        try:
+            with open(path) as watermark_file:
+                data = json.load(watermark_file)
+            return cls(data['last_update_time'], data['task_ids'])
+        except FileNotFoundError:
+            return cls()
+        except (OSError, ValueError, KeyError) as err:
+            logger.warning('could not read watermark %s, start from scratch: %s', path, err)
+            return cls()
+
+    def save(self, path: str = WATERMARK_FILE):
+        tmp_path = f'{path}.tmp'
+        try:
+            with open(tmp_path, 'w') as watermark_file:
+                json.dump(
+                    {'last_update_time': self.last_update_time, 'task_ids': sorted(self.task_ids)},
+                    watermark_file,
+                )
+            os.replace(tmp_path, path)
+        except OSError as err:
+            logger.warning('could not save watermark %s: %s', path, err)
+
+    def query_params(self) -> Dict:
+        """return alaris /task query params which filter out tasks older than watermark"""
+        if TASK_UPDATE_TIME_PARAM and self.last_update_time:
+            return {TASK_UPDATE_TIME_PARAM: self.last_update_time}
+        return {}
+
+    def is_new(self, task: Dict) -> bool:
+        update_time = task['task_last_update_time']
+        if self.last_update_time is None or update_time > self.last_update_time:
+            return True
+        return update_time == self.last_update_time and task['id'] not in self.task_ids
+
+    def advance(self, task: Dict):
+        update_time = task['task_last_update_time']
+        if self.last_update_time is None or update_time > self.last_update_time:
+            self.last_update_time = update_time
+            self.task_ids = {task['id']}
+        elif update_time == self.last_update_time:
+            self.task_ids.add(task['id'])
+
+    def start_from(self, default_start_time: datetime):
+        """set watermark to default_start_time if there is no stored one"""
+        if self.last_update_time is None:
+            self.last_update_time = default_start_time.strftime(TASK_TIME_FORMAT)
+            self.task_ids = set()
+            logger.info('no stored watermark, start from %s', self.last_update_time)
+
+    def iter_unseen_tasks(self, tasks: Iterable[Dict], end_time: datetime) -> Iterator[Dict]:
+        """yield tasks updated after the watermark and before end_time, the watermark is not moved"""
+        end = end_time.strftime(TASK_TIME_FORMAT)
+        logger.info('fetch tasks updated from %s till %s', self.last_update_time, end)
+        for task in tasks:
+            if task['task_last_update_time'] < end and self.is_new(task):
+                yield task
+
+    def iter_advancing(self, tasks: Iterable[Dict]) -> Iterator[Dict]:
+        """yield tasks and move the watermark over them when all tasks were consumed"""
+        # tasks are not ordered by update time, so the mark is moved only when all are seen
+        next_mark = Watermark(self.last_update_time, self.task_ids)
+        for task in tasks:
+            next_mark.advance(task)
+            yield task
+        self.last_update_time = next_mark.last_update_time
+        self.task_ids = next_mark.task_ids
+
+    def iter_new_tasks(self, tasks: Iterable[Dict], end_time: datetime) -> Iterator[Dict]:
+        """
+        yield tasks updated after the watermark and before end_time.
+
+        The watermark is moved forward when all tasks were consumed.
+        """
+        return self.iter_advancing(self.iter_unseen_tasks(tasks, end_time))
@@ -1,23 +1,186 @@
-import os
+import queue
+import threading
+import time
+from typing import Iterable, Iterator
+
 import requests
 
-from dotenv import load_dotenv
+from http_client import POST_RETRY_METHODS, HttpClient, make_retry
+from logger import create_logger
+from metrics import metrics
+from settings import settings
+
+logger = create_logger(__name__, "telegram_notify.log")
 
-load_dotenv()
+TG_TOKEN = settings.tg_token
+TG_CHAT_ID = settings.tg_chat_id
+TG_API_URL = settings.tg_api_url
+# telegram allows about one message per second to the same chat
+TG_MESSAGES_PER_SECOND = settings.tg_messages_per_second
+TG_MESSAGES_BURST = settings.tg_messages_burst
+# name of the alaris instance from ALARIS_INSTANCES_FILE added to messages
+TG_INSTANCE = settings.alaris_instance
+TG_MAX_ATTEMPTS = 5
+TG_MESSAGE_LIMIT = 4096
+MESSAGE_SEPARATOR = "\n\n"
 
-TG_TOKEN = os.getenv("TG_TOKEN")
-TG_CHAT_ID = os.getenv("TG_CHAT_ID")
+# 429 is handled by send_tg_message with retry_after from the answer body
+tg_session = HttpClient(
+    retry=make_retry(statuses=(500, 502, 503, 504), methods=POST_RETRY_METHODS)
+)
 
 
-def send_tg_message(message):
-    url = f"https://api.telegram.org/bot{TG_TOKEN}/sendMessage"
+def send_tg_message(message, session: requests.Session = None):
+    url = f"{TG_API_URL}/bot{TG_TOKEN}/sendMessage"
     json = {
         "chat_id": TG_CHAT_ID,
         "text": message,
         "parse_mode": "html",
     }
-    tg_resp = requests.post(url, json=json)
-    tg_resp.raise_for_status()
+    session = session or tg_session
+    with metrics.span("telegram.send"):
+        for _ in range(TG_MAX_ATTEMPTS):
+            tg_resp = session.post(url, json=json)
+            if tg_resp.status_code != 429:
+                break
+            retry_after = tg_resp.json().get("parameters", {}).get("retry_after", 1)
+            logger.warning("telegram rate limit exceeded, retry after %ss", retry_after)
+            metrics.incr("telegram_retries")
+            time.sleep(retry_after)
+        tg_resp.raise_for_status()
+    metrics.incr("telegram_messages_sent")
+
+
+class TokenBucket:
+    """allow rate events per second with bursts up to capacity"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.rate)
+
+
+def split_message(message: str, limit: int = TG_MESSAGE_LIMIT) -> Iterator[str]:
+    """split too long message by lines, lines longer than limit are cut"""
+    chunk = ""
+    for line in message.split("\n"):
+        while len(line) > limit:
+            if chunk:
+                yield chunk
+                chunk = ""
+            yield line[:limit]
+            line = line[limit:]
+        if chunk and len(chunk) + 1 + len(line) > limit:
+            yield chunk
+            chunk = line
+        else:
+            chunk = f"{chunk}\n{line}" if chunk else line
+    if chunk:
+        yield chunk
+
+
+def pack_messages(messages: Iterable[str], limit: int = TG_MESSAGE_LIMIT) -> Iterator[str]:
+    """join messages into as few telegram messages of at most limit chars as possible"""
+    packed = ""
+    for message in messages:
+        for part in split_message(message, limit):
+            if packed and len(packed) + len(MESSAGE_SEPARATOR) + len(part) > limit:
+                yield packed
+                packed = part
+            else:
+                packed = f"{packed}{MESSAGE_SEPARATOR}{part}" if packed else part
+    if packed:
+        yield packed
+
+
+def send_tg_text(message: str, session: requests.Session = None) -> bool:
+    """send message split into parts of TG_MESSAGE_LIMIT, errors are logged, return True if sent"""
+    try:
+        for part in split_message(message):
+            send_tg_message(part, session=session)
+    except requests.RequestException as err:
+        logger.exception("could not send telegram message\n%s", err)
+        return False
+    return True
+
+
+class NotificationDispatcher:
+    """
+    Send messages to telegram from a background thread.
+
+    Messages queued while the previous one was sent are packed together,
+    sends are limited by a token bucket and failed messages are logged
+    without dropping the rest of the queue.
+    """
+
+    _stop = object()
+
+    def __init__(self, session: requests.Session = None,
+                 rate: float = TG_MESSAGES_PER_SECOND, burst: int = TG_MESSAGES_BURST):
+        self.session = session or tg_session
+        self.bucket = TokenBucket(rate, burst)
+        self.queue = queue.Queue()
+        self.sent = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self._run, name="tg-dispatcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, message: str):
+        self.queue.put(message)
+
+    def close(self):
+        """send everything that was submitted and stop the background thread"""
+        self.queue.put(self._stop)
+        self.thread.join()
+        logger.info("telegram messages sent: %s, failed: %s", self.sent, self.failed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _drain(self):
+        stop = False
+        messages = [self.queue.get()]
+        while True:
+            try:
+                messages.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if self._stop in messages:
+            stop = True
+            messages = [message for message in messages if message is not self._stop]
+        return messages, stop
+
+    def _run(self):
+        stop = False
+        while not stop:
+            messages, stop = self._drain()
+            for message in pack_messages(messages):
+                self.bucket.acquire()
+                try:
+                    send_tg_message(message, session=self.session)
+                    self.sent += 1
+                except requests.RequestException as err:
+                    self.failed += 1
+                    logger.exception("could not send telegram message\n%s", err)
+
+
+def instance_header() -> str:
+    """first line of messages with the alaris instance name, empty for a single instance"""
+    return f"<b>instance</b>: {TG_INSTANCE}\n" if TG_INSTANCE else ""
 
 
 def products_formatter(products, direction):
@@ -30,33 +193,38 @@ def products_formatter(products, direction):
 
 
 def rerating_task_formatter(task):
-    if type(task["src_product_ids"]) == list:
-        src_product = products_formatter(task["src_product_ids"], "src")
+    """format task_records.ExtendedTask as telegram message"""
+    if isinstance(task.src_product_ids, (list, tuple)):
+        src_product = products_formatter(task.src_product_ids, "src")
     else:
-        src_product = f'<b>src products</b>: {task["src_product_ids"]}\n'
-    if type(task["dst_product_ids"]) == list:
-        dst_product = products_formatter(task["dst_product_ids"], "dst")
+        src_product = f"<b>src products</b>: {task.src_product_ids}\n"
+    if isinstance(task.dst_product_ids, (list, tuple)):
+        dst_product = products_formatter(task.dst_product_ids, "dst")
     else:
-        dst_product = f'<b>dst products</b>: {task["dst_product_ids"]}\n'
+        dst_product = f"<b>dst products</b>: {task.dst_product_ids}\n"
     message = (
-        f'<b>task id</b>: {task["task_id"]}\n'
-        f'<b>status</b>: {task["task_status"]}\n'
-        f'<b>task start time</b>: {task["task_start_time"]}\n'
+        f"{instance_header()}"
+        f"<b>task id</b>: {task.task_id}\n"
+        f"<b>status</b>: {task.task_status}\n"
+        f"<b>task start time</b>: {task.task_start_time}\n"
         f"<b>last update time</b>: "
-        f'{task["task_last_uprate_time"]}\n'
+        f"{task.task_last_uprate_time}\n"
         f"{src_product}"
         f"{dst_product}"
-        f'<b>rerating period</b>: from {task["rerating_start_time"]} '
-        f'till {task["rerating_end_time"]}'
+        f"<b>rerating period</b>: from {task.rerating_start_time} "
+        f"till {task.rerating_end_time}"
     )
     return message
 
 
-def send_rerating_notification(tasks):
-    # ToDo handle 429 Client Error: Too Many Requests
-    while tasks:
-        message = rerating_task_formatter(tasks.pop())
-        send_tg_message(message)
+def send_rerating_notification(tasks) -> int:
+    """send a message for every task of tasks iterable, return number of tasks"""
+    count = 0
+    with NotificationDispatcher() as dispatcher:
+        for task in tasks:
+            dispatcher.submit(rerating_task_formatter(task))
+            count += 1
+    return count
 
 
 if __name__ == "__main__":
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# settings are loaded once on import, keep logs and caches of the tests out of the project
+WORK_DIR = tempfile.mkdtemp(prefix="alaris_cli_tests_")
+os.environ["LOG_DIR"] = WORK_DIR
+os.environ["CACHE_DIR"] = WORK_DIR
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
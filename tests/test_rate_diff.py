@@ -0,0 +1,34 @@
+import sms_update_rate
+
+
+def raw_rate(mccmnc, rate, start_date="2024-01-01"):
+    return {"mccmnc": mccmnc, "rate_start_date": start_date, "rate_end_date": "2024-01-31", "rate": rate}
+
+
+def test_diff_rates_keeps_rates_with_other_period_or_value():
+    target = sms_update_rate.collect_rate_list_for_update(
+        ["25001", "25002", "25003"], "2024-01-01", "2024-01-31"
+    )
+    current = [
+        raw_rate("25001", 0),
+        raw_rate("25002", 0.5),
+        raw_rate("25003", 0),
+        raw_rate("25003", 0, start_date="2024-01-10"),
+    ]
+    changed = sms_update_rate.diff_rates(current, target)
+    assert [rate["mccmnc"] for rate in changed] == ["25002", "25003"]
+
+
+def test_dry_run_does_not_upload_and_emits_planned_rows(monkeypatch):
+    def update_sms_rate(*args, **kwargs):
+        raise AssertionError("dry run should not upload rates")
+
+    monkeypatch.setattr(sms_update_rate.alaris_api, "update_sms_rate", update_sms_rate)
+    rows = []
+    report = sms_update_rate.update_product_rates(
+        None, "14023", [raw_rate("25001", 0), raw_rate("25002", 0.5)],
+        "2024-01-01", "2024-01-31", dry_run=True, rate_sink=rows.append,
+    )
+    assert [(row["mccmnc"], row["status"]) for row in rows] == [("25002", "planned")]
+    assert report["unchanged"] == 1
+    assert [rate["mccmnc"] for rate in report["changes"]] == ["25002"]
@@ -0,0 +1,92 @@
+import os
+
+import pytest
+from requests import RequestException
+
+import sms_update_rate
+from settings import Settings
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """keep rate update progress files of every test in its own directory"""
+    monkeypatch.setattr(sms_update_rate, "settings", Settings(cache_dir=str(tmp_path)))
+    return tmp_path
+
+
+class FakeAlaris:
+    """alaris_api.update_sms_rate which records uploaded chunks and fails for failing mccmnc once"""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.uploaded = []
+
+    def update_sms_rate(self, session, product_id, new_rates):
+        codes = [rate["mccmnc"] for rate in new_rates]
+        if self.failing & set(codes):
+            self.failing -= set(codes)
+            raise RequestException(f"chunk {codes} failed")
+        self.uploaded.append(codes)
+        return {"mini_report": {"updated": len(new_rates)}}
+
+
+def zero_rates(count):
+    return sms_update_rate.collect_rate_list_for_update(
+        [str(25001 + code) for code in range(count)], "2024-01-01", "2024-01-31"
+    )
+
+
+def update(rates, fake, monkeypatch):
+    monkeypatch.setattr(sms_update_rate.alaris_api, "update_sms_rate", fake.update_sms_rate)
+    return sms_update_rate.update_rates_in_chunks(
+        None, 14023, rates, "2024-01-01", "2024-01-31", batch_size=3, workers=1
+    )
+
+
+def test_rerun_after_partial_failure_uploads_only_the_rest(cache_dir, monkeypatch):
+    rates = zero_rates(10)
+    fake = FakeAlaris(failing=["25005"])
+    with pytest.raises(RequestException):
+        update(rates, fake, monkeypatch)
+    first_run = [code for chunk in fake.uploaded for code in chunk]
+    assert "25005" not in first_run
+    assert len(first_run) == 7
+    assert os.listdir(cache_dir)
+
+    fake.uploaded.clear()
+    report = update(rates, fake, monkeypatch)
+    assert fake.uploaded == [["25004", "25005", "25006"]]
+    assert report["rates"] == 10
+    assert report["chunks"] == 4
+    assert report["mini_report"] == {"updated": 10}
+    assert os.listdir(cache_dir) == []
+
+
+def test_progress_is_per_product_and_period(cache_dir, monkeypatch):
+    with pytest.raises(RequestException):
+        update(zero_rates(4), FakeAlaris(failing=["25004"]), monkeypatch)
+    progress = sms_update_rate.UpdateProgress(14023, "2024-02-01", "2024-02-29")
+    assert progress.committed == set()
+    progress = sms_update_rate.UpdateProgress(14023, "2024-01-01", "2024-01-31")
+    assert progress.committed == {"25001", "25002", "25003"}
+
+
+def test_unwritable_cache_dir_does_not_fail_the_update(cache_dir, monkeypatch):
+    monkeypatch.setattr(
+        sms_update_rate, "settings", Settings(cache_dir=str(cache_dir / "missing"))
+    )
+    fake = FakeAlaris()
+    report = update(zero_rates(4), fake, monkeypatch)
+    assert len(fake.uploaded) == 2
+    assert report["rates"] == 4
+
+
+def test_report_summary_is_short_for_many_chunks():
+    report = sms_update_rate.consolidate_reports({
+        "14023": {"mini_report": {"updated": 3000}, "chunks": 1000, "rates": 3000},
+        "14024": {"error": "x" * 10000},
+    })
+    report["products"]["14023"]["mini_report"]["messages"] = ["ok"] * 1000
+    summary = sms_update_rate.report_summary(report)
+    assert summary.splitlines()[1] == "14023: 3000 rates in 1000 chunks"
+    assert len(summary) < 300
@@ -0,0 +1,95 @@
+from datetime import datetime
+
+from sms_rerating_task import get_incremental_task
+from task_watermark import Watermark
+
+END_TIME = datetime(2024, 1, 1, 12, 0)
+
+
+def task(task_id, update_time):
+    return {"id": task_id, "task_last_update_time": update_time}
+
+
+def ids(tasks):
+    return [item["id"] for item in tasks]
+
+
+def test_skips_tasks_seen_at_the_boundary():
+    watermark = Watermark("2024.01.01 10:00:00", [1, 2])
+    tasks = [
+        task(1, "2024.01.01 10:00:00"),
+        task(2, "2024.01.01 10:00:00"),
+        task(3, "2024.01.01 10:00:00"),
+        task(4, "2024.01.01 09:59:59"),
+        task(5, "2024.01.01 10:00:01"),
+    ]
+    assert ids(watermark.iter_new_tasks(tasks, END_TIME)) == [3, 5]
+    assert watermark.last_update_time == "2024.01.01 10:00:01"
+    assert watermark.task_ids == {5}
+
+
+def test_keeps_all_ids_of_the_latest_time():
+    watermark = Watermark("2024.01.01 10:00:00", [1])
+    tasks = [
+        task(3, "2024.01.01 10:05:00"),
+        task(2, "2024.01.01 10:00:00"),
+        task(4, "2024.01.01 10:05:00"),
+    ]
+    assert ids(watermark.iter_new_tasks(tasks, END_TIME)) == [3, 2, 4]
+    assert watermark.last_update_time == "2024.01.01 10:05:00"
+    assert watermark.task_ids == {3, 4}
+
+
+def test_tasks_from_end_time_are_left_for_the_next_run():
+    watermark = Watermark("2024.01.01 10:00:00")
+    tasks = [task(1, "2024.01.01 11:59:59"), task(2, "2024.01.01 12:00:00")]
+    assert ids(watermark.iter_new_tasks(tasks, END_TIME)) == [1]
+    assert watermark.last_update_time == "2024.01.01 11:59:59"
+    assert ids(watermark.iter_new_tasks(tasks, datetime(2024, 1, 1, 12, 1))) == [2]
+
+
+def test_is_not_moved_until_all_tasks_are_consumed():
+    watermark = Watermark("2024.01.01 10:00:00", [1])
+    new_tasks = watermark.iter_new_tasks(
+        [task(2, "2024.01.01 10:01:00"), task(3, "2024.01.01 10:02:00")], END_TIME
+    )
+    next(new_tasks)
+    assert watermark.last_update_time == "2024.01.01 10:00:00"
+    assert watermark.task_ids == {1}
+
+
+def test_rerun_after_save_yields_only_new_tasks(tmp_path):
+    path = str(tmp_path / "watermark.json")
+    tasks = [task(1, "2024.01.01 10:00:00"), task(2, "2024.01.01 10:00:00")]
+    watermark = Watermark.load(path)
+    watermark.start_from(datetime(2024, 1, 1, 9, 0))
+    assert ids(watermark.iter_new_tasks(tasks, END_TIME)) == [1, 2]
+    watermark.save(path)
+
+    watermark = Watermark.load(path)
+    tasks.append(task(3, "2024.01.01 10:00:00"))
+    assert ids(watermark.iter_new_tasks(tasks, END_TIME)) == [3]
+    assert watermark.task_ids == {1, 2, 3}
+
+
+def test_broken_file_starts_from_scratch(tmp_path):
+    path = tmp_path / "watermark.json"
+    path.write_text("{")
+    watermark = Watermark.load(str(path))
+    assert watermark.last_update_time is None
+    assert watermark.task_ids == set()
+
+
+def test_tasks_in_progress_do_not_move_the_watermark():
+    watermark = Watermark("2024.01.01 10:00:00")
+    tasks = [
+        dict(task(1, "2024.01.01 10:01:00"), task_param_json='{"autorerating": "0"}'),
+        dict(task(2, "2024.01.01 10:02:00"), task_result="in progress: 10%"),
+    ]
+    assert [record.id for record in get_incremental_task(tasks, watermark, END_TIME)] == [1]
+    assert watermark.last_update_time == "2024.01.01 10:01:00"
+    assert watermark.task_ids == {1}
+
+
+def test_unwritable_path_is_logged_not_raised(tmp_path):
+    Watermark("2024.01.01 10:00:00", [1]).save(str(tmp_path / "missing" / "watermark.json"))